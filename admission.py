@@ -0,0 +1,100 @@
+"""Admission control and per-account rate limits of the HTTP server.
+
+Requests over the concurrency limit wait in a bounded queue for a limited
+time and are rejected afterwards, so under overload clients get a fast error
+instead of a slow response.
+"""
+
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Any, List, Optional, Tuple
+
+RATE_LIMIT_ACCOUNTS = 100000
+ADMITTED = "admitted"
+QUEUED = "queued"
+REJECTED = "rejected"
+
+
+class AdmissionController:
+    """Limit of requests handled at once with a bounded queue of waiting ones.
+
+    Nothing blocks: a request over the limit is queued with a deadline and
+    handed over by `release` when a slot is freed. The caller rejects the
+    requests that do not fit into the queue or outlive their deadlines.
+    """
+
+    def __init__(self, max_concurrent: int, max_queue: int, timeout: float):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.active = 0
+        self.waiting = deque()
+
+    def admit(self, item) -> str:
+        """Take a slot for an item or queue it, return ADMITTED, QUEUED or REJECTED."""
+        with self.lock:
+            if self.active < self.max_concurrent:
+                self.active += 1
+                return ADMITTED
+            if len(self.waiting) >= self.max_queue:
+                return REJECTED
+            self.waiting.append((time.monotonic() + self.timeout, item))
+            return QUEUED
+
+    def release(self) -> Tuple[Any, List]:
+        """Free a slot.
+
+        Return the waiting item taking the slot over, None if there is no
+        such item, and the expired items.
+        """
+        with self.lock:
+            expired = self.pop_expired(time.monotonic())
+            if self.waiting:
+                return self.waiting.popleft()[1], expired
+            self.active -= 1
+            return None, expired
+
+    def expire(self, now: Optional[float] = None) -> List:
+        """Remove and return the waiting items with deadlines before `now`."""
+        with self.lock:
+            return self.pop_expired(time.monotonic() if now is None else now)
+
+    def pop_expired(self, now: float) -> List:
+        expired = []
+        while self.waiting and self.waiting[0][0] <= now:
+            expired.append(self.waiting.popleft()[1])
+        return expired
+
+    def next_deadline(self) -> Optional[float]:
+        with self.lock:
+            return self.waiting[0][0] if self.waiting else None
+
+
+class RateLimiter:
+    """Token buckets of `rate` requests per second and `burst` requests by key.
+
+    Buckets of the least recently seen keys are dropped beyond `size` keys,
+    they are full again by then in practice.
+    """
+
+    def __init__(self, rate: float, burst: int, size: int = RATE_LIMIT_ACCOUNTS):
+        self.rate = rate
+        self.burst = burst
+        self.size = size
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def allow(self, key) -> bool:
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated_at = self.buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated_at) * self.rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self.buckets[key] = (tokens, now)
+            if len(self.buckets) > self.size:
+                self.buckets.popitem(last=False)
+            return allowed
@@ -1,17 +1,24 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from datetime import datetime
-import json
+from collections import OrderedDict
+from datetime import datetime, timedelta
 import logging
 import hashlib
-import uuid
-from optparse import OptionParser
-from http.server import HTTPServer, BaseHTTPRequestHandler
-from typing import Dict, List, Tuple
+import hmac
+import threading
+import time
+from typing import Dict, Iterator, List, Tuple, Union
 
-from req import ClientsInterestsRequest, MethodRequest, OnlineScoreRequest
-from scoring import get_score, get_interests
+from req import (
+    BatchOnlineScoreRequest, ClientsInterestsRequest, MethodRequest,
+    OnlineScoreRequest, ProfileRequest,
+)
+import metrics
+import codec
+import models
+import scoring
+from scoring import get_score, get_scores, get_interests_many
 
 SALT = "Otus"
 ADMIN_SALT = "42"
@@ -19,14 +26,20 @@ OK = 200
 BAD_REQUEST = 400
 FORBIDDEN = 403
 NOT_FOUND = 404
+REQUEST_ENTITY_TOO_LARGE = 413
 INVALID_REQUEST = 422
+TOO_MANY_REQUESTS = 429
 INTERNAL_ERROR = 500
+SERVICE_UNAVAILABLE = 503
 ERRORS = {
     BAD_REQUEST: "Bad Request",
     FORBIDDEN: "Forbidden",
     NOT_FOUND: "Not Found",
     INVALID_REQUEST: "Invalid Request",
+    REQUEST_ENTITY_TOO_LARGE: "Request Entity Too Large",
+    TOO_MANY_REQUESTS: "Too Many Requests",
     INTERNAL_ERROR: "Internal Server Error",
+    SERVICE_UNAVAILABLE: "Service Unavailable",
 }
 UNKNOWN = 0
 MALE = 1
@@ -36,56 +49,97 @@ GENDERS = {
     MALE: "male",
     FEMALE: "female",
 }
+STREAM_THRESHOLD = 1000
+MAX_BODY_SIZE = 10 * 1024 * 1024
+METHODS = ("online_score", "clients_interests", "batch_online_score", "profile")
+AUTH_CACHE_SIZE = 10000
+SERVER_NAMES = (
+    "MainHTTPHandler", "ThreadPoolHTTPServer", "install_shutdown_handler",
+    "serve_threaded", "serve_prefork",
+)
+
+
+class AuthCache:
+    """Admin token of the current hour and a LRU of verified user tokens."""
+
+    def __init__(self, size: int):
+        self.size = size
+        self.verified = OrderedDict()
+        self.lock = threading.Lock()
+        self.admin = (None, 0)
+
+    def get_admin_digest(self) -> str:
+        digest, expires_at = self.admin
+        if time.time() >= expires_at:
+            hour = datetime.now().replace(minute=0, second=0, microsecond=0)
+            string_to_hash = hour.strftime("%Y%m%d%H") + ADMIN_SALT
+            digest = hashlib.sha512(string_to_hash.encode()).hexdigest()
+            expires_at = (hour + timedelta(hours=1)).timestamp()
+            self.admin = (digest, expires_at)
+        return digest
+
+    def is_verified(self, key: Tuple) -> bool:
+        with self.lock:
+            if key in self.verified:
+                self.verified.move_to_end(key)
+                return True
+        return False
+
+    def add_verified(self, key: Tuple):
+        with self.lock:
+            self.verified[key] = True
+            if len(self.verified) > self.size:
+                self.verified.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.verified.clear()
+        self.admin = (None, 0)
+
+
+auth_cache = AuthCache(AUTH_CACHE_SIZE)
+metrics.registry.add_counters(
+    "interests_lookups_total",
+    "Lookups of stored client interests by the way they were served.",
+    "source",
+    scoring.interests_flight.stats
+)
+metrics.registry.add_counters(
+    "score_cache_lookups_total",
+    "Lookups of the score cache by the way they were served.",
+    "result",
+    scoring.score_cache.lookups
+)
 
 
 def check_auth(request):
     if request.is_admin:
-        string_to_hash = datetime.now().strftime("%Y%m%d%H") + ADMIN_SALT
-        digest = hashlib.sha512(string_to_hash.encode()).hexdigest()
-    else:
-        string_to_hash = request.account + request.login + SALT
-        digest = hashlib.sha512(string_to_hash.encode()).hexdigest()
-    if digest == request.token:
+        digest = auth_cache.get_admin_digest()
+        return hmac.compare_digest(digest.encode(), request.token.encode())
+
+    key = (request.account, request.login, request.token)
+    if auth_cache.is_verified(key):
+        return True
+    string_to_hash = request.account + request.login + SALT
+    digest = hashlib.sha512(string_to_hash.encode()).hexdigest()
+    if hmac.compare_digest(digest.encode(), request.token.encode()):
+        auth_cache.add_verified(key)
         return True
     return False
 
 
 def get_valid_request(request_body, request_class):
-    request = request_class()
-    err_msg = None
-    request_params = {
-        n: a for n, a in request_class.__dict__.items() if hasattr(a, "required")
-    }
-    for param_name, param in request_params.items():
-        try:
-            param_value = request_body[param_name]
-        except KeyError:
-            if param.required:
-                request = None
-                err_msg = f"Request does not contain the field '{param_name}'"
-                break
-            continue
-        try:
-            setattr(request, param_name, param_value)
-        except TypeError as exception:
-            request = None
-            err_msg = str(exception)
-            break
+    return request_class.from_body(request_body)
 
-    return err_msg, request
 
+def validate_score_request(arguments):
+    """Return an error message, a valid online score request and its model.
 
-def get_score_response(
-        request: MethodRequest
-) -> Tuple[int, Dict[str, int], List[str]]:
-    """Return info of response to online score request."""
-    if request.is_admin:
-        return OK, {"score": 42}, []
-
-    err_message, score_req = get_valid_request(
-        request.arguments,
-        OnlineScoreRequest
-    )
+    The model is resolved here once, so a reload of models can not remove it
+    before the request is scored.
+    """
+    err_message, score_req = get_valid_request(arguments, OnlineScoreRequest)
+    model = None
 
     if score_req:
         try:
@@ -97,28 +151,116 @@ def get_score_response(
                 err_text = 'The request does not contain any of the pairs: '
                 pairs = 'phone-email, first_name-last_name, gender-birthday'
                 err_message = err_text + pairs
+            else:
+                model = models.registry.get(score_req.model)
         except AttributeError as exception:
             err_message = str(exception)
+        except KeyError:
+            err_message = f"Unknown scoring model '{score_req.model}'"
 
-    response = err_message
-    return_code = INVALID_REQUEST
-    req_params = {}
+    if err_message:
+        score_req = model = None
+    return err_message, score_req, model
 
-    if not err_message:
-        req_params = {n.lstrip("_"): v for n, v in score_req.__dict__.items()}
-        positional_arg_names = ["phone", "email"]
-        args = {n: None for n in positional_arg_names}
-        score = get_score(None, **{**args, **req_params})
-        response = {"score": score}
-        return_code = OK
 
-    return return_code, response, list(req_params.keys())
+def get_score_response(
+        request: MethodRequest,
+        store
+) -> Tuple[int, Dict[str, int], List[str]]:
+    """Return info of response to online score request."""
+    if request.is_admin:
+        return OK, {"score": 42}, []
+
+    err_message, score_req, model = validate_score_request(request.arguments)
+    if err_message:
+        return INVALID_REQUEST, err_message, []
+
+    req_params = score_req.to_kwargs()
+    req_params.pop("model", None)
+    positional_arg_names = ["phone", "email"]
+    args = {n: None for n in positional_arg_names}
+    score = get_score(store, **{**args, **req_params}, model=model)
+    return OK, {"score": score}, list(req_params.keys())
+
+
+def get_batch_score_response(
+        request: MethodRequest,
+        store
+) -> Tuple[int, Dict]:
+    """Return an error code and scores of a batch of online score requests.
+
+    Items failing validation get a None score and an error message keyed by
+    the item index.
+    """
+    err_message, batch_req = get_valid_request(
+        request.arguments,
+        BatchOnlineScoreRequest
+    )
+    if err_message:
+        return INVALID_REQUEST, err_message
+
+    items = batch_req.items
+    if request.is_admin:
+        return OK, {"scores": [42] * len(items), "errors": {}}
+
+    errors = {}
+    valid_params = []
+    positional_arg_names = ["phone", "email"]
+    args = {n: None for n in positional_arg_names}
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            errors[index] = "An item must be an object."
+            continue
+        err_message, score_req, model = validate_score_request(item)
+        if err_message:
+            errors[index] = err_message
+            continue
+        valid_params.append({**args, **score_req.to_kwargs(), "model": model})
+
+    valid_scores = iter(get_scores(store, valid_params))
+    scores = [
+        None if i in errors else next(valid_scores) for i in range(len(items))
+    ]
+    return OK, {"scores": scores, "errors": errors}
+
+
+class InterestsStream:
+    """Interests of many clients fetched and serialized chunk by chunk."""
+
+    def __init__(self, store, client_ids: List[int]):
+        self.store = store
+        self.client_ids = client_ids
+
+    def __len__(self):
+        return len(self.client_ids)
+
+    def __repr__(self):
+        return f"<InterestsStream of {len(self)} clients>"
+
+    def iter_json(self) -> Iterator[bytes]:
+        """Yield parts of the JSON object mapping client ids to interests."""
+        chunk_size = scoring.INTERESTS_CHUNK_SIZE
+        items = get_interests_many(self.store, self.client_ids, chunk_size)
+        separator = b"{"
+        parts = []
+        for cid, interests in items:
+            parts.append(b'%s"%d": %s' % (separator, cid, codec.dumps(interests)))
+            separator = b", "
+            if len(parts) == chunk_size:
+                yield b"".join(parts)
+                parts = []
+        parts.append(b"{}" if separator == b"{" else b"}")
+        yield b"".join(parts)
 
 
 def get_client_interests_response(
         request: MethodRequest,
-) -> Tuple[int, Dict[int, List[str]]]:
-    """Return an error code and a response to client interests request."""
+        store
+) -> Tuple[int, Union[Dict[int, List[str]], InterestsStream]]:
+    """Return an error code and a response to client interests request.
+
+    Interests of more than STREAM_THRESHOLD clients are returned as a stream.
+    """
     err_message, client_interests_request = get_valid_request(
         request.arguments,
         ClientsInterestsRequest
@@ -126,112 +268,146 @@ def get_client_interests_response(
     response = err_message
     return_code = INVALID_REQUEST
     if not err_message:
-        client_ids = client_interests_request.client_ids
-        response = {i: get_interests(1, 1) for i in client_ids}
+        # A streamed object would repeat the keys of repeated ids.
+        client_ids = list(dict.fromkeys(client_interests_request.client_ids))
+        if len(client_ids) > STREAM_THRESHOLD:
+            response = InterestsStream(store, client_ids)
+        else:
+            response = dict(get_interests_many(store, client_ids))
         return_code = OK
     return return_code, response
 
 
-def method_handler(request, context, store):
+def get_profile_response(request: MethodRequest) -> Tuple[int, Dict]:
+    """Return an error code and a response to a profiling control request.
+
+    The action `start` replaces the current profile with a new one, `stop`
+    stops it and `result` only returns its state and output. Profiling is
+    controlled by the admin only.
+    """
+    import profiler
+
+    if not request.is_admin:
+        return FORBIDDEN, None
+    err_message, profile_req = get_valid_request(
+        request.arguments,
+        ProfileRequest
+    )
+    if err_message:
+        return INVALID_REQUEST, err_message
+
+    try:
+        if profile_req.action == "start":
+            profiler.start(
+                profile_req.mode,
+                profile_req.requests,
+                profile_req.seconds
+            )
+        elif profile_req.action == "stop":
+            profiler.stop()
+        elif profile_req.action != "result":
+            return INVALID_REQUEST, "action must be one of: start, stop, result"
+    except ValueError as exception:
+        return INVALID_REQUEST, str(exception)
+    return OK, profiler.result()
+
+
+def get_method_request(request, context):
+    """Validate and authorize the body of a request.
+
+    Return an error code, an error message and a method request. The method
+    request is None if the request is invalid or unauthorized.
+    """
     request_body = request.get("body")
-    return_code = INVALID_REQUEST
+    if not request_body:
+        return INVALID_REQUEST, None, None
+
+    timer = request.get("timer")
+    logging.info("Successfully get request body.")
+    error, method_request = get_valid_request(request_body, MethodRequest)
+    if timer:
+        timer.mark("validate")
+    if not method_request:
+        return INVALID_REQUEST, error, None
+
+    logging.info("Request is valid (id: %s).", context.get("request_id"))
+    successful_auth = check_auth(method_request)
+    if timer:
+        timer.mark("auth")
+    if not successful_auth:
+        return FORBIDDEN, None, None
+    # Only authorized requests spend tokens, so nobody can exhaust the rate
+    # limit of another login.
+    rate_limiter = request.get("rate_limiter")
+    if rate_limiter is not None and not rate_limiter.allow(method_request.login):
+        return TOO_MANY_REQUESTS, None, None
+    return OK, None, method_request
+
+
+def method_handler(request, context, store):
+    return_code, error, method_request = get_method_request(request, context)
+    if not method_request:
+        return error, return_code
+
     response = None
-    error = None
-    if request_body:
-        logging.info("Successfully get request body.")
-        error, method_request = get_valid_request(request_body, MethodRequest)
-        if method_request:
-            logging.info(f"Request is valid (id: {context.get('request_id')}.")
-            successful_auth = check_auth(method_request)
-            return_code = FORBIDDEN
-            if successful_auth:
-                request_method = method_request.method
-                if request_method == "online_score":
-                    return_code, response, filled_fields = get_score_response(
-                        method_request
-                    )
-                    if return_code == OK:
-                        context["has"] = filled_fields
-                elif request_method == "clients_interests":
-                    return_code, response = get_client_interests_response(
-                        method_request
-                    )
-                    if return_code == OK:
-                        context["nclients"] = len(response)
-                else:
-                    err_msg = f"The invalid request method {request_method}"
-                    logging.error(err_msg + str(context))
-                    return_code = BAD_REQUEST
-
-    response = response or error
+    request_method = method_request.method
+    if request_method == "online_score":
+        return_code, response, filled_fields = get_score_response(
+            method_request,
+            store
+        )
+        if return_code == OK:
+            context["has"] = filled_fields
+    elif request_method == "clients_interests":
+        return_code, response = get_client_interests_response(
+            method_request,
+            store
+        )
+        if return_code == OK:
+            context["nclients"] = len(response)
+    elif request_method == "batch_online_score":
+        return_code, response = get_batch_score_response(
+            method_request,
+            store
+        )
+        if return_code == OK:
+            context["nitems"] = len(response["scores"])
+    elif request_method == "profile":
+        return_code, response = get_profile_response(method_request)
+    else:
+        err_msg = f"The invalid request method {request_method}"
+        logging.error("%s %s", err_msg, context)
+        return_code = BAD_REQUEST
+
+    timer = request.get("timer")
+    if timer:
+        timer.mark("handle")
     return response, return_code
 
 
-class MainHTTPHandler(BaseHTTPRequestHandler):
-    router = {
-        "method": method_handler
-    }
-    store = None
+def get_method_label(request_body) -> str:
+    """Return a method name of a request body to label metrics with."""
+    if not isinstance(request_body, dict):
+        return ""
+    method = request_body.get("method")
+    return method if method in METHODS else "unknown"
 
-    def get_request_id(self, headers):
-        return headers.get("HTTP_X_REQUEST_ID", uuid.uuid4().hex)
 
-    def do_POST(self):
-        response, code = {}, OK
-        context = {"request_id": self.get_request_id(self.headers)}
-        logging.info(f'Request handling started. {context}')
-        request = None
-        try:
-            data_string = self.rfile.read(int(self.headers["Content-Length"]))
-            request = json.loads(data_string)
-        except:
-            logging.error("Failed to read request body.")
-            code = BAD_REQUEST
-
-        if request:
-            path = self.path.strip("/")
-            logging.info("%s: %s %s" % (self.path, data_string, context["request_id"]))
-            if path in self.router:
-                try:
-                    response, code = self.router[path](
-                        {"body": request, "headers": self.headers},
-                        context,
-                        self.store
-                    )
-                except Exception as e:
-                    logging.exception("Unexpected error: %s" % e)
-                    code = INTERNAL_ERROR
-            else:
-                code = NOT_FOUND
+def make_response(response, code) -> Dict:
+    """Return a response body for a handler result."""
+    if code not in ERRORS:
+        return {"response": response, "code": code}
+    return {"error": response or ERRORS.get(code, "Unknown Error"), "code": code}
 
-        self.send_response(code)
-        self.send_header("Content-Type", "application/json")
-        self.end_headers()
-        if code not in ERRORS:
-            r = {"response": response, "code": code}
-        else:
-            r = {"error": response or ERRORS.get(code, "Unknown Error"), "code": code}
-        context.update(r)
-        logging.info(context)
-        self.wfile.write(json.dumps(r).encode())
-        return
+
+def __getattr__(name):
+    """Import the HTTP server on the first access to it, e.g. MainHTTPHandler."""
+    if name in SERVER_NAMES:
+        import server
+        return getattr(server, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 if __name__ == "__main__":
-    op = OptionParser()
-    op.add_option("-p", "--port", action="store", type=int, default=8080)
-    op.add_option("-l", "--log", action="store", default=None)
-    (opts, args) = op.parse_args()
-    logging.basicConfig(
-        filename=opts.log,
-        level=logging.INFO,
-        format="[%(asctime)s] %(levelname).1s %(message)s",
-        datefmt="%Y.%m.%d %H:%M:%S"
-    )
-    server = HTTPServer(("localhost", opts.port), MainHTTPHandler)
-    logging.info("Starting server at %s" % opts.port)
-    try:
-        server.serve_forever()
-    except KeyboardInterrupt:
-        pass
-    server.server_close()
+    from server import main
+    main()
@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Asyncio HTTP/1.1 server for the scoring API.
+
+Connections are kept alive between requests and pipelined requests are
+answered in the order they were received.
+"""
+
+import asyncio
+import logging
+import signal
+import uuid
+from typing import Dict, List, Tuple
+
+from api import (
+    BAD_REQUEST, ERRORS, INTERNAL_ERROR, INVALID_REQUEST, MAX_BODY_SIZE,
+    NOT_FOUND, OK, REQUEST_ENTITY_TOO_LARGE,
+    get_batch_score_response, get_method_label, get_method_request,
+    get_valid_request, make_response, validate_score_request,
+)
+import codec
+import logs
+import metrics
+from req import ClientsInterestsRequest, MethodRequest
+from scoring import get_interests_many, get_score_async
+
+KEEPALIVE_TIMEOUT = 15
+BODY_TIMEOUT = 15
+MAX_HEADERS_SIZE = 64 * 1024
+REASONS = {OK: "OK", **ERRORS}
+
+
+async def get_score_response_async(
+        request: MethodRequest,
+        store
+) -> Tuple[int, Dict[str, int], List[str]]:
+    """Return info of response to online score request."""
+    if request.is_admin:
+        return OK, {"score": 42}, []
+
+    err_message, score_req, model = validate_score_request(request.arguments)
+    if err_message:
+        return INVALID_REQUEST, err_message, []
+
+    req_params = score_req.to_kwargs()
+    req_params.pop("model", None)
+    positional_arg_names = ["phone", "email"]
+    args = {n: None for n in positional_arg_names}
+    score = await get_score_async(store, **{**args, **req_params}, model=model)
+    return OK, {"score": score}, list(req_params.keys())
+
+
+async def get_client_interests_response_async(
+        request: MethodRequest,
+        store
+) -> Tuple[int, Dict[int, List[str]]]:
+    """Return an error code and a response to client interests request."""
+    err_message, client_interests_request = get_valid_request(
+        request.arguments,
+        ClientsInterestsRequest
+    )
+    if err_message:
+        return INVALID_REQUEST, err_message
+
+    client_ids = client_interests_request.client_ids
+    loop = asyncio.get_running_loop()
+    interests = await loop.run_in_executor(
+        None,
+        lambda: dict(get_interests_many(store, client_ids))
+    )
+    return OK, interests
+
+
+async def method_handler_async(request, context, store):
+    return_code, error, method_request = get_method_request(request, context)
+    if not method_request:
+        return error, return_code
+
+    response = None
+    request_method = method_request.method
+    if request_method == "online_score":
+        return_code, response, filled_fields = await get_score_response_async(
+            method_request,
+            store
+        )
+        if return_code == OK:
+            context["has"] = filled_fields
+    elif request_method == "clients_interests":
+        return_code, response = await get_client_interests_response_async(
+            method_request,
+            store
+        )
+        if return_code == OK:
+            context["nclients"] = len(response)
+    elif request_method == "batch_online_score":
+        return_code, response = get_batch_score_response(
+            method_request,
+            store
+        )
+        if return_code == OK:
+            context["nitems"] = len(response["scores"])
+    else:
+        err_msg = f"The invalid request method {request_method}"
+        logging.error("%s %s", err_msg, context)
+        return_code = BAD_REQUEST
+
+    timer = request.get("timer")
+    if timer:
+        timer.mark("handle")
+    return response, return_code
+
+
+class AsyncHTTPServer:
+    router = {
+        "method": method_handler_async
+    }
+
+    def __init__(
+            self,
+            host: str,
+            port: int,
+            store=None,
+            max_body_size: int = MAX_BODY_SIZE
+    ):
+        self.host = host
+        self.port = port
+        self.store = store
+        self.max_body_size = max_body_size
+        self.server = None
+        self.connections = {}
+        self.closing = False
+
+    async def handle_connection(self, reader, writer):
+        task = asyncio.current_task()
+        self.connections[task] = False
+        try:
+            while not self.closing:
+                try:
+                    keep_alive = await self.handle_request(reader, writer, task)
+                except (
+                        asyncio.IncompleteReadError,
+                        asyncio.LimitOverrunError,
+                        asyncio.TimeoutError,
+                        ConnectionError,
+                ):
+                    break
+                if not keep_alive:
+                    break
+        except asyncio.CancelledError:
+            pass
+        finally:
+            del self.connections[task]
+            writer.close()
+
+    async def handle_request(self, reader, writer, task) -> bool:
+        """Answer one request and return whether to keep the connection."""
+        head = await asyncio.wait_for(
+            reader.readuntil(b"\r\n\r\n"),
+            KEEPALIVE_TIMEOUT
+        )
+        self.connections[task] = True
+        try:
+            request_line, *header_lines = head.decode("latin-1").split("\r\n")
+            method, path, version = request_line.split()
+            headers = {}
+            for line in header_lines:
+                if line:
+                    name, value = line.split(":", 1)
+                    name = name.strip().lower()
+                    if name == "content-length" and name in headers:
+                        raise ValueError("Duplicate Content-Length")
+                    headers[name] = value.strip()
+            # Chunked bodies are not supported: a body of unknown length
+            # would be parsed as the next request of the connection.
+            if "transfer-encoding" in headers:
+                raise ValueError("Transfer-Encoding is not supported")
+            content_length = headers.get("content-length", "0")
+            if not content_length.isdigit():
+                raise ValueError(f"Invalid Content-Length: {content_length}")
+            content_length = int(content_length)
+        except ValueError as e:
+            logging.error("Invalid request head: %s", e)
+            r = make_response(None, BAD_REQUEST)
+            await self.write_response(writer, BAD_REQUEST, r, False)
+            return False
+        if content_length > self.max_body_size:
+            logging.error("Request body is too large: %s", content_length)
+            r = make_response(None, REQUEST_ENTITY_TOO_LARGE)
+            await self.write_response(writer, REQUEST_ENTITY_TOO_LARGE, r, False)
+            return False
+
+        body = await asyncio.wait_for(
+            reader.readexactly(content_length),
+            BODY_TIMEOUT
+        )
+        connection = headers.get("connection", "").lower()
+        if version == "HTTP/1.1":
+            keep_alive = connection != "close"
+        else:
+            keep_alive = connection == "keep-alive"
+        keep_alive = keep_alive and not self.closing
+
+        if method == "GET" and path.strip("/") == "metrics" and metrics.enabled:
+            await self.write_metrics(writer, keep_alive)
+        elif method != "POST":
+            r = make_response(None, BAD_REQUEST)
+            await self.write_response(writer, BAD_REQUEST, r, keep_alive)
+        else:
+            code, r, timer, method_label = await self.dispatch(
+                path,
+                headers,
+                body
+            )
+            await self.write_response(writer, code, r, keep_alive)
+            if timer:
+                timer.mark("serialize")
+                metrics.record(timer, method_label, code)
+        self.connections[task] = False
+        return keep_alive
+
+    async def dispatch(self, path, headers, body):
+        response, code = {}, OK
+        timer = metrics.start_timer()
+        context = {"request_id": headers.get("x-request-id", uuid.uuid4().hex)}
+        logs.start_request()
+        logging.info("Request handling started. %s", context)
+        request = None
+        try:
+            request = codec.loads(body)
+            if timer:
+                timer.mark("parse")
+        except:
+            logging.error("Failed to read request body.")
+            code = BAD_REQUEST
+
+        if request:
+            path = path.strip("/")
+            logging.info("%s: %s %s", path, body, context["request_id"])
+            if path in self.router:
+                try:
+                    response, code = await self.router[path](
+                        {"body": request, "headers": headers, "timer": timer},
+                        context,
+                        self.store
+                    )
+                except Exception as e:
+                    logging.exception("Unexpected error: %s", e)
+                    code = INTERNAL_ERROR
+            else:
+                code = NOT_FOUND
+
+        r = make_response(response, code)
+        context.update(r)
+        # Failed requests are warnings, so sampling does not drop them.
+        logging.log(logging.INFO if code == OK else logging.WARNING, context)
+        return code, r, timer, get_method_label(request)
+
+    async def write_response(self, writer, code, r, keep_alive):
+        body = codec.dumps(r)
+        await self.write(writer, code, body, "application/json", keep_alive)
+
+    async def write_metrics(self, writer, keep_alive):
+        body = metrics.registry.render().encode()
+        await self.write(writer, OK, body, metrics.CONTENT_TYPE, keep_alive)
+
+    async def write(self, writer, code, body, content_type, keep_alive):
+        head = (
+            f"HTTP/1.1 {code} {REASONS.get(code, '')}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n"
+            f"\r\n"
+        )
+        writer.write(head.encode("latin-1") + body)
+        await writer.drain()
+
+    async def shutdown(self):
+        """Stop accepting connections and wait for requests in flight."""
+        logging.info("Shutting down.")
+        self.closing = True
+        self.server.close()
+        for task, busy in list(self.connections.items()):
+            if not busy:
+                task.cancel()
+        if self.connections:
+            await asyncio.wait(list(self.connections))
+
+    async def serve(self):
+        self.server = await asyncio.start_server(
+            self.handle_connection,
+            self.host,
+            self.port,
+            limit=MAX_HEADERS_SIZE
+        )
+        stopped = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stopped.set)
+        async with self.server:
+            await stopped.wait()
+            await self.shutdown()
+
+
+def serve_async(host: str, port: int, store=None, max_body_size=MAX_BODY_SIZE):
+    asyncio.run(AsyncHTTPServer(host, port, store, max_body_size).serve())
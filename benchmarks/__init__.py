@@ -0,0 +1,6 @@
+"""Benchmarks of the scoring API.
+
+micro - micro-benchmarks of request validation, auth and scoring;
+loadgen - HTTP load generator replaying request payloads against a server;
+startup - cold import time of the modules and time to first response.
+"""
@@ -0,0 +1,142 @@
+"""HTTP load generator for the /method/ endpoint.
+
+Usage: python -m benchmarks.loadgen [--url URL] [--payloads file.jsonl]
+    [--requests N] [--concurrency C] [--json report.json]
+
+Without a payload file a mix of online_score and clients_interests requests
+is generated. The report contains latency percentiles in milliseconds and
+the throughput in requests per second.
+"""
+
+import http.client
+import json
+import threading
+import time
+from collections import Counter
+from itertools import cycle, islice
+from optparse import OptionParser
+from typing import Dict, List
+from urllib.parse import urlsplit
+
+from benchmarks.payloads import generate, read_jsonl
+
+
+def percentile(sorted_values: List[float], share: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(share * len(sorted_values)))
+    return sorted_values[index]
+
+
+class LoadGenerator:
+    def __init__(self, url: str, bodies: List[bytes], concurrency: int):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.path = parts.path or "/"
+        self.bodies = bodies
+        self.concurrency = concurrency
+        self.next_index = 0
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.codes = Counter()
+        self.failures = 0
+
+    def take_body(self):
+        with self.lock:
+            if self.next_index >= len(self.bodies):
+                return None
+            body = self.bodies[self.next_index]
+            self.next_index += 1
+            return body
+
+    def worker(self):
+        connection = http.client.HTTPConnection(self.host, self.port, timeout=10)
+        latencies = []
+        codes = Counter()
+        failures = 0
+        headers = {"Content-Type": "application/json"}
+        while True:
+            body = self.take_body()
+            if body is None:
+                break
+            started_at = time.perf_counter()
+            try:
+                connection.request("POST", self.path, body, headers)
+                response = connection.getresponse()
+                response.read()
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                failures += 1
+                continue
+            latencies.append(time.perf_counter() - started_at)
+            codes[response.status] += 1
+        connection.close()
+        with self.lock:
+            self.latencies.extend(latencies)
+            self.codes.update(codes)
+            self.failures += failures
+
+    def run(self) -> Dict:
+        threads = [
+            threading.Thread(target=self.worker)
+            for _ in range(self.concurrency)
+        ]
+        started_at = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started_at
+
+        latencies = sorted(self.latencies)
+        to_ms = 1000
+        return {
+            "requests": len(self.bodies),
+            "completed": len(latencies),
+            "failures": self.failures,
+            "codes": {str(c): n for c, n in sorted(self.codes.items())},
+            "concurrency": self.concurrency,
+            "elapsed_s": round(elapsed, 3),
+            "rps": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+            "latency_ms": {
+                "mean": round(sum(latencies) / len(latencies) * to_ms, 3)
+                if latencies else 0.0,
+                "p50": round(percentile(latencies, 0.50) * to_ms, 3),
+                "p95": round(percentile(latencies, 0.95) * to_ms, 3),
+                "p99": round(percentile(latencies, 0.99) * to_ms, 3),
+                "max": round(latencies[-1] * to_ms, 3) if latencies else 0.0,
+            },
+        }
+
+
+def main():
+    op = OptionParser(usage="python -m benchmarks.loadgen [options]")
+    op.add_option("-u", "--url", action="store",
+                  default="http://127.0.0.1:8080/method/")
+    op.add_option("-p", "--payloads", action="store", default=None,
+                  help="JSONL file of request bodies")
+    op.add_option("-n", "--requests", action="store", type=int, default=10000)
+    op.add_option("-c", "--concurrency", action="store", type=int, default=16)
+    op.add_option("-j", "--json", action="store", default=None,
+                  help="Write the report to a JSON file")
+    (opts, args) = op.parse_args()
+
+    if opts.payloads:
+        payloads = list(read_jsonl(opts.payloads))
+        if not payloads:
+            op.error(f"There are no request bodies in {opts.payloads}")
+    else:
+        payloads = generate(min(opts.requests, 1000))
+    encoded = [json.dumps(p).encode() for p in payloads]
+    bodies = list(islice(cycle(encoded), opts.requests))
+
+    report = LoadGenerator(opts.url, bodies, opts.concurrency).run()
+    print(json.dumps(report, indent=2))
+    if opts.json:
+        with open(opts.json, "w") as file:
+            json.dump(report, file, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""Micro-benchmarks of the request path.
+
+Usage: python -m benchmarks.micro [--json results.json] [--filter name]
+"""
+
+import json
+import timeit
+from optparse import OptionParser
+from typing import Callable, Dict, List, Tuple
+
+import api
+import req
+import scoring
+from benchmarks.payloads import interests_request, score_request
+
+SCORE_ARGUMENTS = {
+    "phone": "79175002040",
+    "email": "stupnikov@otus.ru",
+    "gender": 1,
+    "birthday": "01.01.2000",
+    "first_name": "a",
+    "last_name": "b",
+}
+DESCRIPTOR_VALUES = [
+    (req.OnlineScoreRequest, "first_name", "a"),
+    (req.OnlineScoreRequest, "email", "stupnikov@otus.ru"),
+    (req.OnlineScoreRequest, "phone", "79175002040"),
+    (req.OnlineScoreRequest, "birthday", "01.01.2000"),
+    (req.OnlineScoreRequest, "gender", 1),
+    (req.ClientsInterestsRequest, "client_ids", list(range(10))),
+    (req.ClientsInterestsRequest, "date", "19.07.2017"),
+]
+
+
+def descriptor_benchmark(request_class, field_name: str, value) -> Callable:
+    instance = request_class()
+
+    def run():
+        setattr(instance, field_name, value)
+    return run
+
+
+def uncached_auth(method_request) -> Callable:
+    def run():
+        api.auth_cache.clear()
+        api.check_auth(method_request)
+    return run
+
+
+def uncached_score(store, score_params: Dict) -> Callable:
+    def run():
+        scoring.score_cache.clear()
+        scoring.get_score(store, **score_params)
+    return run
+
+
+def get_benchmarks() -> List[Tuple[str, Callable]]:
+    score_body = score_request(SCORE_ARGUMENTS)
+    interests_body = interests_request(list(range(10)))
+    _, method_request = api.get_valid_request(score_body, req.MethodRequest)
+    _, score_req, model = api.validate_score_request(SCORE_ARGUMENTS)
+    score_params = {**score_req.to_kwargs(), "model": model}
+    client_ids = list(range(1000))
+    store = None
+    benchmarks = [
+        ("get_valid_request.MethodRequest",
+         lambda: api.get_valid_request(score_body, req.MethodRequest)),
+        ("get_valid_request.OnlineScoreRequest",
+         lambda: api.get_valid_request(SCORE_ARGUMENTS, req.OnlineScoreRequest)),
+        ("get_valid_request.ClientsInterestsRequest",
+         lambda: api.get_valid_request(
+             interests_body["arguments"],
+             req.ClientsInterestsRequest
+         )),
+    ]
+    for request_class, field_name, value in DESCRIPTOR_VALUES:
+        descriptor = request_class.__dict__[field_name]
+        name = f"descriptor.{type(descriptor).__name__}.{field_name}"
+        benchmarks.append(
+            (name, descriptor_benchmark(request_class, field_name, value))
+        )
+    benchmarks += [
+        ("check_auth.cached", lambda: api.check_auth(method_request)),
+        ("check_auth.uncached", uncached_auth(method_request)),
+        ("get_score.cached", lambda: scoring.get_score(store, **score_params)),
+        ("get_score.uncached", uncached_score(store, score_params)),
+        ("sample_interests_many.1000",
+         lambda: scoring.sample_interests_many(client_ids)),
+        ("method_handler.online_score",
+         lambda: api.method_handler({"body": score_body}, {}, store)),
+        ("method_handler.clients_interests",
+         lambda: api.method_handler({"body": interests_body}, {}, store)),
+    ]
+    return benchmarks
+
+
+def measure(function: Callable, repeat: int = 5) -> Dict:
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    best = min(timer.repeat(repeat=repeat, number=number)) / number
+    return {
+        "mean_us": round(best * 1e6, 3),
+        "ops_per_sec": round(1 / best),
+        "loops": number,
+    }
+
+
+def main():
+    op = OptionParser(usage="python -m benchmarks.micro [options]")
+    op.add_option("-j", "--json", action="store", default=None,
+                  help="Write results to a JSON file")
+    op.add_option("-f", "--filter", action="store", default="",
+                  help="Run benchmarks with names containing the text")
+    (opts, args) = op.parse_args()
+
+    results = {}
+    for name, function in get_benchmarks():
+        if opts.filter not in name:
+            continue
+        results[name] = measure(function)
+        result = results[name]
+        print(f"{name:50} {result['mean_us']:>12.3f} us {result['ops_per_sec']:>12} op/s")
+
+    if opts.json:
+        with open(opts.json, "w") as file:
+            json.dump({"benchmarks": results}, file, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
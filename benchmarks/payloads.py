@@ -0,0 +1,79 @@
+"""Realistic request payloads with valid tokens."""
+
+import hashlib
+import json
+import random
+from datetime import datetime
+from typing import Dict, Iterator, List
+
+from api import ADMIN_SALT, SALT
+from req import ADMIN_LOGIN
+
+SCORE_ARGUMENTS = [
+    {"phone": "79175002040", "email": "stupnikov@otus.ru"},
+    {"phone": 79175002040, "email": "stupnikov@otus.ru"},
+    {"gender": 1, "birthday": "01.01.2000", "first_name": "a", "last_name": "b"},
+    {"gender": 0, "birthday": "01.01.2000"},
+    {"first_name": "a", "last_name": "b"},
+    {"phone": "79175002040", "email": "stupnikov@otus.ru", "gender": 1,
+     "birthday": "01.01.2000", "first_name": "a", "last_name": "b"},
+]
+
+
+def sign(body: Dict) -> Dict:
+    """Set a valid token of a request body."""
+    if body.get("login") == ADMIN_LOGIN:
+        string_to_hash = datetime.now().strftime("%Y%m%d%H") + ADMIN_SALT
+    else:
+        string_to_hash = body.get("account", "") + body.get("login", "") + SALT
+    body["token"] = hashlib.sha512(string_to_hash.encode()).hexdigest()
+    return body
+
+
+def score_request(arguments: Dict) -> Dict:
+    return sign({
+        "account": "horns&hoofs",
+        "login": "h&f",
+        "method": "online_score",
+        "arguments": arguments,
+    })
+
+
+def interests_request(client_ids: List[int]) -> Dict:
+    return sign({
+        "account": "horns&hoofs",
+        "login": "h&f",
+        "method": "clients_interests",
+        "arguments": {"client_ids": client_ids, "date": "19.07.2017"},
+    })
+
+
+def generate(count: int, seed: int = 0) -> List[Dict]:
+    """Return a mix of online score and client interests requests."""
+    rng = random.Random(seed)
+    payloads = []
+    for _ in range(count):
+        if rng.random() < 0.7:
+            payloads.append(score_request(rng.choice(SCORE_ARGUMENTS)))
+        else:
+            client_ids = rng.sample(range(100000), rng.randint(1, 20))
+            payloads.append(interests_request(client_ids))
+    return payloads
+
+
+def read_jsonl(path: str) -> Iterator[Dict]:
+    """Yield request bodies from a JSONL file.
+
+    A line is either a request body or an object keeping a request body in
+    the field "body". Lines of other shapes are skipped.
+    """
+    with open(path, encoding="utf-8") as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(record, dict) and isinstance(record.get("body"), dict):
+                record = record["body"]
+            if isinstance(record, dict) and "method" in record:
+                yield record
@@ -0,0 +1,109 @@
+"""Startup time of the scoring API.
+
+Usage: python -m benchmarks.startup [--repeat N] [--mode MODE] [--json report.json]
+
+Every measurement runs in a new interpreter. The cold import of a module is
+measured inside the interpreter and as the wall time of the whole process.
+The time to first response is the time from spawning `python api.py` until
+it answers an online_score request.
+"""
+
+import http.client
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from optparse import OptionParser
+from typing import Dict, List
+
+from benchmarks.payloads import SCORE_ARGUMENTS, score_request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODULES = ("api", "server", "async_api", "bulk")
+IMPORT_SCRIPT = (
+    "import time; started_at = time.perf_counter(); import {module}; "
+    "print(time.perf_counter() - started_at)"
+)
+POLL_INTERVAL = 0.005
+START_TIMEOUT = 10.0
+
+
+def summarize(seconds: List[float]) -> Dict:
+    to_ms = 1000
+    return {
+        "min": round(min(seconds) * to_ms, 3),
+        "median": round(statistics.median(seconds) * to_ms, 3),
+        "max": round(max(seconds) * to_ms, 3),
+    }
+
+
+def measure_import(module: str) -> Dict:
+    started_at = time.perf_counter()
+    output = subprocess.run(
+        [sys.executable, "-c", IMPORT_SCRIPT.format(module=module)],
+        cwd=ROOT,
+        check=True,
+        capture_output=True,
+        text=True
+    ).stdout
+    return {
+        "import": float(output),
+        "process": time.perf_counter() - started_at,
+    }
+
+
+def measure_first_response(port: int, mode: str) -> float:
+    body = json.dumps(score_request(SCORE_ARGUMENTS[0])).encode()
+    started_at = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "api.py", "-p", str(port), "-m", mode, "-w", "1",
+         "-l", os.devnull],
+        cwd=ROOT,
+        stderr=subprocess.DEVNULL
+    )
+    try:
+        while time.perf_counter() - started_at < START_TIMEOUT:
+            connection = http.client.HTTPConnection("127.0.0.1", port, timeout=1)
+            try:
+                connection.request("POST", "/method/", body)
+                connection.getresponse().read()
+                return time.perf_counter() - started_at
+            except OSError:
+                time.sleep(POLL_INTERVAL)
+            finally:
+                connection.close()
+        raise RuntimeError(f"The server did not answer in {START_TIMEOUT} seconds")
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main():
+    op = OptionParser(usage="python -m benchmarks.startup [options]")
+    op.add_option("-n", "--repeat", action="store", type=int, default=10)
+    op.add_option("-p", "--port", action="store", type=int, default=8099)
+    op.add_option("-m", "--mode", action="store", type="choice",
+                  choices=("thread", "prefork", "async"), default="thread")
+    op.add_option("-j", "--json", action="store", default=None,
+                  help="Write the report to a JSON file")
+    (opts, args) = op.parse_args()
+
+    report = {"import_ms": {}, "process_ms": {}}
+    for module in MODULES:
+        runs = [measure_import(module) for _ in range(opts.repeat)]
+        report["import_ms"][module] = summarize([r["import"] for r in runs])
+        report["process_ms"][module] = summarize([r["process"] for r in runs])
+    report["first_response_ms"] = summarize([
+        measure_first_response(opts.port, opts.mode)
+        for _ in range(opts.repeat)
+    ])
+    print(json.dumps(report, indent=2))
+    if opts.json:
+        with open(opts.json, "w") as file:
+            json.dump(report, file, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
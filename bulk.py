@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Offline bulk scoring of JSONL files.
+
+Every input line is a request body. In the `method` mode it goes through
+method_handler like a request to the server, in the `score` mode its online
+score arguments are validated and scored without authorization. An output
+line with a response is written for every input line, in the input order.
+
+Lines are processed by a pool of processes in chunks, and at most `window`
+chunks are in flight at once, so memory usage does not depend on a file size.
+"""
+
+import logging
+import os
+import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from optparse import OptionParser
+from typing import List
+
+import codec
+from api import (
+    BAD_REQUEST, INTERNAL_ERROR, INVALID_REQUEST, OK, InterestsStream,
+    make_response, method_handler, validate_score_request,
+)
+from scoring import get_interests_many, get_score
+
+METHOD_MODE = "method"
+SCORE_MODE = "score"
+CHUNK_SIZE = 1000
+
+
+def handle_method(body) -> dict:
+    response, code = method_handler({"body": body, "headers": {}}, {}, None)
+    if isinstance(response, InterestsStream):
+        # A stream saves memory of an HTTP response only, a line is written
+        # at once.
+        response = dict(get_interests_many(response.store, response.client_ids))
+    return make_response(response, code)
+
+
+def handle_score(body) -> dict:
+    arguments = body.get("arguments", body) if isinstance(body, dict) else body
+    if not isinstance(arguments, dict):
+        return make_response(None, INVALID_REQUEST)
+    err_message, score_req, model = validate_score_request(arguments)
+    if err_message:
+        return make_response(err_message, INVALID_REQUEST)
+    params = {"phone": None, "email": None, **score_req.to_kwargs(), "model": model}
+    return make_response({"score": get_score(None, **params)}, OK)
+
+
+HANDLERS = {
+    METHOD_MODE: handle_method,
+    SCORE_MODE: handle_score,
+}
+
+
+def process_chunk(mode: str, lines: List[bytes]) -> bytes:
+    """Return output lines of a chunk of input lines."""
+    handle = HANDLERS[mode]
+    output = []
+    for line in lines:
+        try:
+            body = codec.loads(line)
+        except ValueError:
+            result = make_response(None, BAD_REQUEST)
+        else:
+            try:
+                result = handle(body)
+            except Exception as e:
+                logging.exception("Unexpected error: %s", e)
+                result = make_response(None, INTERNAL_ERROR)
+        output.append(codec.dumps(result))
+    output.append(b"")
+    return b"\n".join(output)
+
+
+def read_chunks(file, chunk_size: int):
+    lines = (line for line in file if line.strip())
+    while True:
+        chunk = list(islice(lines, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def score_file(
+        input_file,
+        output_file,
+        mode: str = METHOD_MODE,
+        workers: int = None,
+        chunk_size: int = CHUNK_SIZE,
+        window: int = None
+) -> int:
+    """Process lines of an input file, return the number of processed lines."""
+    processed = 0
+    workers = workers or os.cpu_count()
+    window = window or 2 * workers
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for chunk in read_chunks(input_file, chunk_size):
+            if len(pending) >= window:
+                output_file.write(pending.popleft().result())
+            pending.append(executor.submit(process_chunk, mode, chunk))
+            processed += len(chunk)
+        while pending:
+            output_file.write(pending.popleft().result())
+    return processed
+
+
+if __name__ == "__main__":
+    op = OptionParser(usage="python bulk.py [options] INPUT OUTPUT")
+    op.add_option("-m", "--mode", action="store", type="choice",
+                  choices=tuple(HANDLERS), default=METHOD_MODE)
+    op.add_option("-w", "--workers", action="store", type=int, default=None)
+    op.add_option("-c", "--chunk", action="store", type=int, default=CHUNK_SIZE,
+                  help="Number of lines processed by a worker at once")
+    op.add_option("--window", action="store", type=int, default=None,
+                  help="Maximal number of chunks in flight")
+    (opts, args) = op.parse_args()
+    if len(args) != 2:
+        op.error("INPUT and OUTPUT files are required, '-' means stdin/stdout")
+
+    input_path, output_path = args
+    input_file = sys.stdin.buffer if input_path == "-" else open(input_path, "rb")
+    output_file = sys.stdout.buffer if output_path == "-" else open(output_path, "wb")
+    try:
+        count = score_file(
+            input_file,
+            output_file,
+            opts.mode,
+            opts.workers,
+            opts.chunk,
+            opts.window
+        )
+    finally:
+        if input_path != "-":
+            input_file.close()
+        if output_path != "-":
+            output_file.close()
+    print(f"Processed {count} lines.", file=sys.stderr)
@@ -0,0 +1,80 @@
+"""Sampled capture of requests and responses for replay.
+
+A share of the handled requests is put into a bounded queue together with
+the responses and the handling time, and written by a background thread to
+a gzip-compressed file of JSON lines. Tokens of the requests are redacted.
+When the queue is full, entries are dropped instead of blocking a request.
+"""
+
+import gzip
+import random
+import time
+
+import codec
+from api import TOO_MANY_REQUESTS
+from logs import QUEUE_SIZE, BackgroundWriter
+
+REDACTED = "<redacted>"
+# Replaying profiling control requests would start profiles.
+SKIPPED_METHODS = ("profile",)
+# Rate limited requests depend on the load of the captured server, a replay
+# of them would be a mismatch.
+SKIPPED_CODES = (TOO_MANY_REQUESTS,)
+
+
+class TrafficRecorder(BackgroundWriter):
+    name = "capture-writer"
+    # Appends of processes to one gzip file would corrupt it.
+    per_process = True
+
+    def __init__(self, path: str, sample_rate: float, queue_size: int = QUEUE_SIZE):
+        BackgroundWriter.__init__(self, path, queue_size)
+        self.sample_rate = sample_rate
+
+    def sample(self) -> bool:
+        """Decide whether to capture the next request."""
+        return self.sample_rate >= 1 or random.random() < self.sample_rate
+
+    def record(self, body, response, code: int, elapsed: float):
+        if not isinstance(body, dict) or body.get("method") in SKIPPED_METHODS:
+            return
+        if code in SKIPPED_CODES:
+            return
+        entry = {
+            "ts": time.time(),
+            "elapsed": elapsed,
+            "body": {**body, "token": REDACTED} if "token" in body else body,
+            "code": code,
+        }
+        if hasattr(response, "iter_json"):
+            # Streamed responses are too large to keep, their size is enough
+            # to compare them.
+            entry["streamed"] = len(response)
+        else:
+            entry["response"] = response
+        self.put(entry)
+
+    def open(self):
+        # Opened on the first entry, so a prefork parent handling no
+        # requests leaves no file.
+        return gzip.open(self.path, "ab")
+
+    def write(self, batch: list):
+        file = self.get_stream()
+        file.write(b"".join(codec.dumps(e) + b"\n" for e in batch))
+        file.flush()
+
+
+def read_capture(path: str):
+    """Yield entries of a capture file.
+
+    A file of a running server may end in the middle of a compressed block,
+    its complete lines are read.
+    """
+    with gzip.open(path, "rb") as file:
+        try:
+            for line in file:
+                if line.strip():
+                    yield codec.loads(line)
+        except EOFError:
+            return
@@ -0,0 +1,71 @@
+"""JSON codec using the fastest installed library.
+
+orjson is preferred, then ujson, then the standard library. Values the fast
+libraries can not handle (e.g. integers out of the 64-bit range) are passed
+to the standard library.
+"""
+
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+def read_body(rfile, length: int) -> memoryview:
+    """Read a request body of a known length into a preallocated buffer."""
+    view = memoryview(bytearray(length))
+    received = 0
+    while received < length:
+        count = rfile.readinto(view[received:])
+        if not count:
+            raise ValueError("The request body is shorter than its length.")
+        received += count
+    return view
+
+
+if orjson is not None:
+    NAME = "orjson"
+
+    def loads(data):
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            return json.loads(bytes(data))
+
+    def dumps(obj) -> bytes:
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            return json.dumps(obj).encode()
+
+elif ujson is not None:
+    NAME = "ujson"
+
+    def loads(data):
+        data = bytes(data)
+        try:
+            return ujson.loads(data)
+        except ValueError:
+            return json.loads(data)
+
+    def dumps(obj) -> bytes:
+        try:
+            return ujson.dumps(obj, ensure_ascii=False).encode()
+        except (TypeError, OverflowError):
+            return json.dumps(obj).encode()
+
+else:
+    NAME = "json"
+
+    def loads(data):
+        return json.loads(bytes(data) if isinstance(data, memoryview) else data)
+
+    def dumps(obj) -> bytes:
+        return json.dumps(obj).encode()
@@ -0,0 +1,250 @@
+"""Non-blocking structured logging.
+
+Log records are put into a bounded queue by the threads handling requests
+and written to a file as JSON lines by a background thread in batches. When
+the queue is full, records are dropped instead of blocking a request. The
+writer thread is shared with the traffic capture as BackgroundWriter.
+"""
+
+import contextvars
+import json
+import logging
+import os
+import queue
+import random
+import sys
+import threading
+from typing import List, Optional
+
+QUEUE_SIZE = 10000
+BATCH_SIZE = 512
+FLUSH_INTERVAL = 0.5
+WRITE_BUFFER_SIZE = 256 * 1024
+
+# The decision of SuccessSampler for the request handled by the current
+# thread or asyncio task, None out of requests.
+sampled = contextvars.ContextVar("sampled", default=None)
+sampler = None
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": round(record.created, 6),
+            "level": record.levelname,
+            "thread": record.threadName,
+        }
+        if isinstance(record.msg, dict) and not record.args:
+            # Structured messages, like the results of requests, are
+            # written as fields of the entry.
+            for name, value in record.msg.items():
+                entry.setdefault(name, value)
+        else:
+            entry["msg"] = record.getMessage()
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class SuccessSampler(logging.Filter):
+    """Pass INFO and DEBUG records of a share of requests and all the others.
+
+    A request is sampled once by `start_request`, so its records are written
+    or dropped together. Records out of requests are sampled one by one.
+    """
+
+    def __init__(self, rate: float):
+        logging.Filter.__init__(self)
+        self.rate = rate
+
+    def sample(self) -> bool:
+        return self.rate >= 1 or random.random() < self.rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING or self.rate >= 1:
+            return True
+        decision = sampled.get()
+        if decision is None:
+            return self.sample()
+        return decision
+
+
+def start_request():
+    """Sample INFO records of a request handled by the current thread or task."""
+    if sampler is not None:
+        sampled.set(sampler.sample())
+
+
+class DroppingQueueHandler(logging.Handler):
+    """Put records into the queue of a writer, drop them if it is full."""
+
+    def __init__(self, writer: "BatchWriter"):
+        logging.Handler.__init__(self)
+        self.writer = writer
+
+    def emit(self, record: logging.LogRecord):
+        # Arguments of a record may change after the call, so the message
+        # is rendered here. The rest of the formatting is done by the writer.
+        try:
+            if isinstance(record.msg, dict) and not record.args:
+                record.msg = dict(record.msg)
+            else:
+                record.msg = record.getMessage()
+            record.args = None
+            if record.exc_info:
+                record.exc_text = logging.Formatter().formatException(
+                    record.exc_info
+                )
+                record.exc_info = None
+            self.writer.put(record)
+        except Exception:
+            self.handleError(record)
+
+    def close(self):
+        self.writer.stop()
+        logging.Handler.close(self)
+
+
+class BackgroundWriter:
+    """Background thread writing queued items to a file in batches.
+
+    Items are put without blocking and dropped when the queue is full. The
+    file is opened by `open` on the first batch and a batch is written by
+    `write`. A forked process starts a writer of its own, writing to
+    `path.<pid>` if `per_process` is set.
+    """
+
+    name = "writer"
+    per_process = False
+
+    def __init__(self, path: Optional[str], queue_size: int = QUEUE_SIZE):
+        self.path = path
+        self.queue_size = queue_size
+        self.items = queue.Queue(queue_size)
+        self.dropped = 0
+        self.stream = None
+        self.thread = None
+        self.stopped = False
+
+    def put(self, item):
+        try:
+            self.items.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+
+    def start(self):
+        self.start_thread()
+        os.register_at_fork(after_in_child=self.restart_in_child)
+
+    def start_thread(self):
+        self.thread = threading.Thread(
+            target=self.run,
+            name=self.name,
+            daemon=True
+        )
+        self.thread.start()
+
+    def restart_in_child(self):
+        """Start a new writer in a forked process: threads do not survive fork."""
+        if self.stopped:
+            return
+        # The inherited stream belongs to the parent, closing it here would
+        # write its buffer twice.
+        self.stream = None
+        if self.per_process and self.path:
+            self.path = f"{self.path}.{os.getpid()}"
+        self.items = queue.Queue(self.queue_size)
+        self.start_thread()
+
+    def get_stream(self):
+        if self.stream is None:
+            self.stream = self.open()
+        return self.stream
+
+    def open(self):
+        raise NotImplementedError
+
+    def write(self, batch: list):
+        raise NotImplementedError
+
+    def run(self):
+        stopped = False
+        while not stopped:
+            try:
+                batch = [self.items.get(timeout=FLUSH_INTERVAL)]
+            except queue.Empty:
+                continue
+            while len(batch) < BATCH_SIZE:
+                try:
+                    batch.append(self.items.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                stopped = True
+                batch = [item for item in batch if item is not None]
+            if batch:
+                self.write(batch)
+        if self.stream is not None and self.stream is not sys.stderr:
+            self.stream.close()
+
+    def stop(self):
+        """Write the queued items and stop the thread."""
+        self.stopped = True
+        if self.thread is None or not self.thread.is_alive():
+            return
+        self.items.put(None)
+        self.thread.join()
+
+
+class BatchWriter(BackgroundWriter):
+    """Writer of log records as JSON lines, to stderr without a path."""
+
+    name = "log-writer"
+
+    def __init__(self, path: Optional[str], queue_size: int = QUEUE_SIZE):
+        BackgroundWriter.__init__(self, path, queue_size)
+        self.formatter = JsonFormatter()
+
+    def start(self):
+        # A log file that can not be opened fails the start, not the thread.
+        self.get_stream()
+        BackgroundWriter.start(self)
+
+    def open(self):
+        if not self.path:
+            return sys.stderr
+        return open(self.path, "a", encoding="utf-8", buffering=WRITE_BUFFER_SIZE)
+
+    def write(self, batch: List[logging.LogRecord]):
+        lines = []
+        for record in batch:
+            try:
+                lines.append(self.formatter.format(record))
+            except Exception:
+                continue
+        if lines:
+            stream = self.get_stream()
+            stream.write("\n".join(lines) + "\n")
+            stream.flush()
+
+
+def setup_async_logging(
+        path: Optional[str],
+        level: int = logging.INFO,
+        sample_rate: float = 1.0,
+        queue_size: int = QUEUE_SIZE
+) -> BatchWriter:
+    """Route the root logger to a background writer of JSON records.
+
+    The queued records are written when the logging module shuts down.
+    """
+    global sampler
+    writer = BatchWriter(path, queue_size)
+    writer.start()
+    sampler = SuccessSampler(sample_rate)
+    handler = DroppingQueueHandler(writer)
+    handler.addFilter(sampler)
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.handlers = [handler]
+    return writer
@@ -0,0 +1,126 @@
+"""Latency histograms of request handling stages.
+
+Stage timings of a request are collected by a StageTimer and recorded into
+histograms labeled by the stage, the request method and the response code.
+Counters collected by other modules are registered with add_counters. The
+metrics are rendered in the Prometheus text format.
+"""
+
+import threading
+from bisect import bisect_left
+from time import perf_counter
+from typing import Callable, Dict, List, Optional, Tuple
+
+BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+    0.25, 0.5, 1.0, 2.5, 5.0,
+)
+METRIC_NAME = "scoring_stage_duration_seconds"
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+enabled = True
+
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Registry:
+    def __init__(self):
+        self.histograms: Dict[Tuple[str, str, int], Histogram] = {}
+        self.counters: Dict[str, Tuple[str, str, Callable[[], Dict]]] = {}
+        self.lock = threading.Lock()
+
+    def add_counters(
+            self,
+            name: str,
+            description: str,
+            label: str,
+            collect: Callable[[], Dict]
+    ):
+        """Render the values returned by collect as counters labeled by keys.
+
+        Adding counters under a name that is already registered replaces
+        them, so a module imported twice (e.g. run as __main__) is not
+        rendered twice.
+        """
+        self.counters[name] = (description, label, collect)
+
+    def observe(self, stages: List[Tuple[str, float]], method: str, code: int):
+        with self.lock:
+            for stage, seconds in stages:
+                key = (stage, method, code)
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    histogram = self.histograms[key] = Histogram()
+                histogram.observe(seconds)
+
+    def render(self) -> str:
+        lines = [
+            f"# HELP {METRIC_NAME} Time spent in a request handling stage.",
+            f"# TYPE {METRIC_NAME} histogram",
+        ]
+        with self.lock:
+            for (stage, method, code), histogram in sorted(self.histograms.items()):
+                labels = f'stage="{stage}",method="{method}",code="{code}"'
+                cumulative = 0
+                bounds = [str(b) for b in BUCKETS] + ["+Inf"]
+                for bound, count in zip(bounds, histogram.counts):
+                    cumulative += count
+                    lines.append(
+                        f'{METRIC_NAME}_bucket{{{labels},le="{bound}"}} {cumulative}'
+                    )
+                lines.append(f"{METRIC_NAME}_sum{{{labels}}} {histogram.sum}")
+                lines.append(f"{METRIC_NAME}_count{{{labels}}} {histogram.count}")
+        for name, (description, label, collect) in self.counters.items():
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} counter")
+            for key, value in collect().items():
+                lines.append(f'{name}{{{label}="{key}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+    def clear(self):
+        with self.lock:
+            self.histograms.clear()
+
+
+class StageTimer:
+    """Durations of the consecutive stages of one request."""
+    __slots__ = ("started_at", "last", "stages")
+
+    def __init__(self):
+        self.started_at = self.last = perf_counter()
+        self.stages = []
+
+    def mark(self, stage: str):
+        """Finish a stage started at the previous mark."""
+        now = perf_counter()
+        self.stages.append((stage, now - self.last))
+        self.last = now
+
+
+registry = Registry()
+
+
+def start_timer() -> Optional[StageTimer]:
+    """Return a timer of a new request, None if metrics are disabled."""
+    if enabled:
+        return StageTimer()
+    return None
+
+
+def record(timer: Optional[StageTimer], method: str, code: int):
+    if timer is None:
+        return
+    stages = timer.stages + [("total", timer.last - timer.started_at)]
+    registry.observe(stages, method, code)
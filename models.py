@@ -0,0 +1,212 @@
+"""Registry of scoring models.
+
+A model is a bias and a list of rules. A rule adds its weight to a score when
+all of its fields are filled:
+
+    {
+        "default": "base",
+        "models": {
+            "base": {
+                "bias": 0,
+                "rules": [
+                    {"fields": ["phone"], "weight": 1.5},
+                    {"fields": ["birthday", "gender"], "weight": 1.5}
+                ]
+            }
+        }
+    }
+
+Every model is compiled into a Python function when it is loaded, so scoring
+a request does not interpret the definition. Models loaded from a file
+replace the registered ones at once, a running server reloads the file when
+it is changed.
+"""
+
+import hashlib
+import json
+import logging
+import math
+import os
+import threading
+from typing import Dict, List, Optional, Tuple
+
+FIELDS = ("phone", "email", "birthday", "gender", "first_name", "last_name")
+SIGNATURE = (
+    "phone, email, birthday=None, gender=None, first_name=None, last_name=None"
+)
+DEFAULT_NAME = "default"
+DEFAULT_MODEL = {
+    "bias": 0,
+    "rules": [
+        {"fields": ["phone"], "weight": 1.5},
+        {"fields": ["email"], "weight": 1.5},
+        {"fields": ["birthday", "gender"], "weight": 1.5},
+        {"fields": ["first_name", "last_name"], "weight": 0.5},
+    ],
+}
+POLL_INTERVAL = 5.0
+
+
+class Model:
+    """A compiled scoring model.
+
+    `key` changes with the definition, so cached scores of an older version
+    of a model are not used.
+    """
+    __slots__ = ("name", "key", "bias", "rules", "score", "score_rows")
+
+    def __init__(self, name: str, definition: Dict):
+        self.name = name
+        self.bias = get_weight(definition.get("bias", 0), "bias")
+        rules = definition.get("rules")
+        if not isinstance(rules, list):
+            raise ValueError(f"rules of the model {name} must be a list")
+        self.rules = [parse_rule(rule) for rule in rules]
+        version = hashlib.md5(
+            json.dumps(definition, sort_keys=True).encode()
+        ).hexdigest()[:8]
+        self.key = f"{name}@{version}"
+        self.score, self.score_rows = self.compile()
+
+    def compile(self):
+        """Return functions scoring a request and a list of request dicts."""
+        lines = [f"def score({SIGNATURE}):", f"    score = {self.bias!r}"]
+        for fields, weight in self.rules:
+            lines.append(f"    if {' and '.join(fields)}:")
+            lines.append(f"        score += {weight!r}")
+        lines.append("    return score")
+        lines += [
+            "def score_rows(rows):",
+            "    scores = []",
+            "    for row in rows:",
+            "        get = row.get",
+            f"        score = {self.bias!r}",
+        ]
+        for fields, weight in self.rules:
+            condition = " and ".join(f"get({f!r})" for f in fields)
+            lines.append(f"        if {condition}:")
+            lines.append(f"            score += {weight!r}")
+        lines.append("        scores.append(score)")
+        lines.append("    return scores")
+        namespace = {}
+        exec(compile("\n".join(lines), f"<model {self.name}>", "exec"), namespace)
+        return namespace["score"], namespace["score_rows"]
+
+
+def get_weight(value, name: str):
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ValueError(f"{name} must be a number")
+    if not math.isfinite(value):
+        raise ValueError(f"{name} must be finite")
+    return value
+
+
+def parse_rule(rule) -> Tuple[Tuple[str, ...], float]:
+    if not isinstance(rule, dict):
+        raise ValueError("a rule must be an object")
+    fields = rule.get("fields")
+    if not isinstance(fields, list) or not fields:
+        raise ValueError("fields of a rule must be a non-empty list")
+    for field in fields:
+        if field not in FIELDS:
+            raise ValueError(f"unknown field {field!r}, expected one of {FIELDS}")
+    return tuple(fields), get_weight(rule.get("weight"), "weight of a rule")
+
+
+class ModelRegistry:
+    """Models by names and the name of the default model.
+
+    Both are replaced by one assignment, so a request sees either the old or
+    the new set of models.
+    """
+
+    def __init__(self):
+        self.state = ({DEFAULT_NAME: Model(DEFAULT_NAME, DEFAULT_MODEL)}, DEFAULT_NAME)
+        self.path = None
+        self.signature = None
+        self.stopped = threading.Event()
+        self.thread = None
+        self.interval = POLL_INTERVAL
+
+    def get(self, name: Optional[str] = None) -> Model:
+        """Return a model by name, the default one if the name is None."""
+        models, default_name = self.state
+        return models[default_name if name is None else name]
+
+    def load(self, config: Dict):
+        """Compile models of a config and replace the registered ones.
+
+        Raise ValueError if the config is invalid, the registry is left as it
+        is then.
+        """
+        if not isinstance(config, dict) or not isinstance(config.get("models"), dict):
+            raise ValueError("a config must contain an object of models")
+        models = {DEFAULT_NAME: Model(DEFAULT_NAME, DEFAULT_MODEL)}
+        for name, definition in config["models"].items():
+            if not isinstance(definition, dict):
+                raise ValueError(f"the model {name} must be an object")
+            models[name] = Model(name, definition)
+        default_name = config.get("default", DEFAULT_NAME)
+        if default_name not in models:
+            raise ValueError(f"the default model {default_name} is not defined")
+        self.state = (models, default_name)
+
+    def load_file(self, path: str):
+        signature = get_signature(path)
+        with open(path, encoding="utf-8") as file:
+            self.load(json.load(file))
+        self.path = path
+        self.signature = signature
+
+    def reload_if_changed(self) -> bool:
+        """Load the file of models if it is changed, return True if it is."""
+        try:
+            signature = get_signature(self.path)
+            if signature == self.signature:
+                return False
+            # A broken file is reported once, not on every check.
+            self.signature = signature
+            with open(self.path, encoding="utf-8") as file:
+                self.load(json.load(file))
+        except (OSError, ValueError) as e:
+            logging.error("Failed to reload scoring models from %s: %s", self.path, e)
+            return False
+        logging.info("Scoring models are reloaded from %s", self.path)
+        return True
+
+    def start_polling(self, interval: float = POLL_INTERVAL):
+        """Check the file of models for changes every `interval` seconds."""
+        self.interval = interval
+        self.start_thread()
+        # Threads do not survive fork, prefork workers start their own.
+        os.register_at_fork(after_in_child=self.restart_in_child)
+
+    def restart_in_child(self):
+        if not self.stopped.is_set():
+            self.start_thread()
+
+    def start_thread(self):
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(
+            target=self.poll,
+            name="models-reload",
+            daemon=True
+        )
+        self.thread.start()
+
+    def poll(self):
+        while not self.stopped.wait(self.interval):
+            self.reload_if_changed()
+
+    def stop_polling(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+
+def get_signature(path: str) -> Tuple[int, int]:
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+registry = ModelRegistry()
@@ -0,0 +1,203 @@
+"""On-demand profiling of a running server.
+
+Two kinds of profiles are taken:
+
+* `cprofile`: the next `requests` requests handled by the threaded server
+  run under cProfile, the output is a pstats report;
+* `sample`: stacks of all the threads are sampled for `seconds` seconds by a
+  background thread, the output is collapsed stacks ready for flame graphs.
+
+Only one profile is kept at a time. When no profile of requests is running,
+the server checks the `armed` flag of the module and nothing else.
+"""
+
+import cProfile
+import io
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+
+CPROFILE_MODE = "cprofile"
+SAMPLE_MODE = "sample"
+MAX_REQUESTS = 1000
+MAX_SECONDS = 60
+SAMPLE_INTERVAL = 0.005
+STATS_LIMIT = 50
+
+armed = False
+profile = None
+lock = threading.Lock()
+
+
+class RequestProfile:
+    """cProfile statistics of the next `requests` requests.
+
+    Requests are profiled one at a time, the ones coming while another
+    request is profiled are handled as usual.
+    """
+    format = "pstats"
+
+    def __init__(self, requests: int):
+        self.requests = requests
+        self.remaining = requests
+        self.busy = False
+        self.stats = None
+        self.lock = threading.Lock()
+
+    @property
+    def done(self) -> bool:
+        return self.remaining == 0 and not self.busy
+
+    def take(self) -> bool:
+        """Reserve the profiling of a request, return False if it is busy."""
+        with self.lock:
+            if self.busy or self.remaining == 0:
+                return False
+            self.busy = True
+            self.remaining -= 1
+            return True
+
+    def add(self, request_profile: cProfile.Profile):
+        global armed
+        with self.lock:
+            if self.stats is None:
+                self.stats = pstats.Stats(request_profile)
+            else:
+                self.stats.add(request_profile)
+            self.busy = False
+            if self.remaining == 0 and profile is self:
+                armed = False
+
+    def stop(self):
+        global armed
+        with self.lock:
+            self.remaining = 0
+            armed = False
+
+    def output(self) -> str:
+        with self.lock:
+            if self.stats is None:
+                return ""
+            stream = io.StringIO()
+            self.stats.stream = stream
+            self.stats.sort_stats("cumulative").print_stats(STATS_LIMIT)
+            return stream.getvalue()
+
+
+class SamplingProfile:
+    """Counts of the stacks of all threads sampled every `interval` seconds."""
+    format = "collapsed"
+
+    def __init__(self, seconds: float, interval: float = SAMPLE_INTERVAL):
+        self.seconds = seconds
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(
+            target=self.run,
+            name="profiler",
+            daemon=True
+        )
+
+    @property
+    def done(self) -> bool:
+        return not self.thread.is_alive()
+
+    def run(self):
+        own_id = threading.get_ident()
+        deadline = time.monotonic() + self.seconds
+        while time.monotonic() < deadline and not self.stopped.is_set():
+            frames = sys._current_frames()
+            stacks = [
+                collapse(frame) for thread_id, frame in frames.items()
+                if thread_id != own_id
+            ]
+            del frames
+            with self.lock:
+                self.stacks.update(stacks)
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def output(self) -> str:
+        with self.lock:
+            return "".join(
+                f"{stack} {count}\n" for stack, count in self.stacks.most_common()
+            )
+
+
+def collapse(frame) -> str:
+    """Return a stack of a frame as function names from the root, joined by ';'."""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+def start(mode: str, requests: int = None, seconds: float = None):
+    """Replace the current profile with a new one.
+
+    Raise ValueError if the arguments are invalid.
+    """
+    global armed, profile
+    if mode == CPROFILE_MODE:
+        if not isinstance(requests, int) or not 0 < requests <= MAX_REQUESTS:
+            raise ValueError(f"requests must be an integer from 1 to {MAX_REQUESTS}")
+        new_profile = RequestProfile(requests)
+    elif mode == SAMPLE_MODE:
+        if not isinstance(seconds, (int, float)) or not 0 < seconds <= MAX_SECONDS:
+            raise ValueError(f"seconds must be a number from 0 to {MAX_SECONDS}")
+        new_profile = SamplingProfile(seconds)
+    else:
+        raise ValueError(f"mode must be one of: {CPROFILE_MODE}, {SAMPLE_MODE}")
+
+    with lock:
+        if profile is not None:
+            profile.stop()
+        profile = new_profile
+        if mode == CPROFILE_MODE:
+            armed = True
+        else:
+            profile.thread.start()
+
+
+def stop():
+    with lock:
+        if profile is not None:
+            profile.stop()
+
+
+def result() -> dict:
+    """Return the state and the output of the current profile."""
+    with lock:
+        current = profile
+    if current is None:
+        return {"status": "idle"}
+    return {
+        "status": "done" if current.done else "running",
+        "format": current.format,
+        "output": current.output(),
+    }
+
+
+def wrap(handle):
+    """Return a request handler profiled if the current profile takes it."""
+    current = profile
+    if not isinstance(current, RequestProfile) or not current.take():
+        return handle
+
+    def profiled(*args):
+        request_profile = cProfile.Profile()
+        try:
+            return request_profile.runcall(handle, *args)
+        finally:
+            current.add(request_profile)
+
+    return profiled
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Replay of captured traffic against method_handler.
+
+Requests of capture files are signed with valid tokens again, except the
+ones that were rejected as unauthorized, and passed to method_handler one by
+one. Every response is compared with the captured one: interests of clients
+are compared by client ids only, the rest of responses must be equal. The
+latency of method_handler is compared with the captured one or with the
+report of a previous replay.
+
+With `--speed` the requests are spaced as they were captured, sped up by the
+given factor. Without it the requests are replayed as fast as possible.
+"""
+
+import json
+import sys
+import time
+from functools import partial
+from optparse import OptionParser
+from typing import Dict, List, Optional
+
+import codec
+import models
+from api import FORBIDDEN, INTERNAL_ERROR, method_handler
+from benchmarks.loadgen import percentile
+from benchmarks.payloads import sign
+from capture import read_capture
+from store import Store, UnixSocketConnection
+
+MAX_REPORTED_MISMATCHES = 20
+
+
+def normalize(response):
+    """Return a response as it is after JSON serialization."""
+    return codec.loads(codec.dumps(response))
+
+
+def get_mismatch(entry: Dict, response, code: int) -> Optional[str]:
+    """Return a description of a difference from a captured response."""
+    if code != entry["code"]:
+        return f"code {code} != {entry['code']}"
+    if "streamed" in entry:
+        if not hasattr(response, "iter_json") or len(response) != entry["streamed"]:
+            return f"not a stream of {entry['streamed']} clients"
+        return None
+    response = normalize(response)
+    expected = entry.get("response")
+    if entry["body"].get("method") == "clients_interests" and code == 200:
+        if set(response) != set(expected):
+            return "client ids differ"
+        return None
+    if response != expected:
+        return f"response {response!r} != {expected!r}"
+    return None
+
+
+def summarize(seconds: List[float]) -> Dict:
+    seconds = sorted(seconds)
+    to_ms = 1000
+    return {
+        "mean": round(sum(seconds) / len(seconds) * to_ms, 4) if seconds else 0.0,
+        "p50": round(percentile(seconds, 0.50) * to_ms, 4),
+        "p95": round(percentile(seconds, 0.95) * to_ms, 4),
+        "p99": round(percentile(seconds, 0.99) * to_ms, 4),
+    }
+
+
+def replay(entries, store=None, speed: float = 0) -> Dict:
+    """Replay captured entries, return a report of mismatches and latency."""
+    latencies = []
+    captured_latencies = []
+    mismatches = []
+    started_at = first_ts = None
+    for index, entry in enumerate(entries):
+        if speed > 0:
+            if first_ts is None:
+                started_at, first_ts = time.monotonic(), entry["ts"]
+            delay = (entry["ts"] - first_ts) / speed - (time.monotonic() - started_at)
+            if delay > 0:
+                time.sleep(delay)
+
+        body = dict(entry["body"])
+        if "token" in body and entry["code"] != FORBIDDEN:
+            try:
+                sign(body)
+            except TypeError:
+                # The account or the login is not a string, the token was
+                # never checked.
+                pass
+        handled_at = time.perf_counter()
+        try:
+            response, code = method_handler({"body": body, "headers": {}}, {}, store)
+        except Exception:
+            # The server answers with an empty response then.
+            response, code = {}, INTERNAL_ERROR
+        latencies.append(time.perf_counter() - handled_at)
+        captured_latencies.append(entry["elapsed"])
+
+        mismatch = get_mismatch(entry, response, code)
+        if mismatch:
+            mismatches.append({"index": index, "method": body.get("method"), "difference": mismatch})
+
+    return {
+        "requests": len(latencies),
+        "mismatches": len(mismatches),
+        "examples": mismatches[:MAX_REPORTED_MISMATCHES],
+        "latency_ms": summarize(latencies),
+        "captured_latency_ms": summarize(captured_latencies),
+    }
+
+
+def compare_latency(report: Dict, baseline: Dict) -> Dict:
+    """Return ratios of the replay latency to the baseline one."""
+    return {
+        name: round(value / baseline[name], 3) if baseline.get(name) else None
+        for name, value in report["latency_ms"].items()
+    }
+
+
+def main():
+    op = OptionParser(usage="python replay.py [options] CAPTURE...")
+    op.add_option("-s", "--speed", action="store", type=float, default=0,
+                  help="Replay the captured timing sped up by the factor, "
+                       "0 for no delays")
+    op.add_option("--store", action="store", default=None,
+                  help="Unix socket of the key-value storage")
+    op.add_option("--models", action="store", default=None,
+                  help="JSON file of scoring models the capture was made with")
+    op.add_option("-b", "--baseline", action="store", default=None,
+                  help="Report of a previous replay to compare the latency with")
+    op.add_option("-j", "--json", action="store", default=None,
+                  help="Write the report to a JSON file")
+    (opts, args) = op.parse_args()
+    if not args:
+        op.error("At least one capture file is required")
+
+    if opts.models:
+        models.registry.load_file(opts.models)
+    store = None
+    if opts.store:
+        store = Store(partial(UnixSocketConnection, opts.store))
+    entries = [entry for path in args for entry in read_capture(path)]
+    entries.sort(key=lambda e: e["ts"])
+    report = replay(entries, store, opts.speed)
+    if opts.baseline:
+        with open(opts.baseline) as file:
+            baseline = json.load(file)["latency_ms"]
+    else:
+        baseline = report["captured_latency_ms"]
+    report["latency_ratio"] = compare_latency(report, baseline)
+    print(json.dumps(report, indent=2))
+    if opts.json:
+        with open(opts.json, "w") as file:
+            json.dump(report, file, indent=2, sort_keys=True)
+    return 1 if report["mismatches"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
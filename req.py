@@ -1,7 +1,48 @@
+import time
 from collections.abc import Iterable
-from datetime import datetime
+from datetime import date, datetime, timedelta
+from functools import lru_cache
 
 ADMIN_LOGIN = "admin"
+DATE_ERROR = "{} must be a string containing a date as DD.MM.YYYY"
+DATE_FORMAT = "%d.%m.%Y"
+DATE_CACHE_SIZE = 4096
+MAX_AGE = 70
+
+birthday_limit = (0, None)
+
+
+@lru_cache(maxsize=DATE_CACHE_SIZE)
+def parse_date(value: str) -> datetime:
+    """Parse a date as DD.MM.YYYY, raise ValueError if it is invalid."""
+    if (
+            len(value) == 10
+            and value[2] == "."
+            and value[5] == "."
+            and value.isascii()
+            and value[:2].isdigit()
+            and value[3:5].isdigit()
+            and value[6:].isdigit()
+    ):
+        return datetime(int(value[6:]), int(value[3:5]), int(value[:2]))
+    # Other forms accepted by strptime, e.g. days and months of one digit.
+    return datetime.strptime(value, DATE_FORMAT)
+
+
+def get_birthday_limit() -> datetime:
+    """Return the midnight after the day of birth of the oldest allowed person.
+
+    The limit is computed once a day.
+    """
+    global birthday_limit
+    expires_at, limit = birthday_limit
+    if time.time() >= expires_at:
+        today = date.today()
+        oldest_birthday = today.replace(year=today.year - MAX_AGE)
+        limit = datetime.combine(oldest_birthday + timedelta(days=1), datetime.min.time())
+        tomorrow = datetime.combine(today + timedelta(days=1), datetime.min.time())
+        birthday_limit = (tomorrow.timestamp(), limit)
+    return limit
 
 
 class BaseDescriptor:
@@ -16,8 +57,12 @@ class BaseDescriptor:
         self.required = required
         self.nullable = nullable
         self.type = type_class
+        self.type_error = f"{self.name} must be {self.type}"
+        self.empty_error = f"{self.name} can not be empty."
 
     def __get__(self, instance, cls):
+        if instance is None:
+            return self
         try:
             attribute_value = getattr(instance, self.name)
         except AttributeError:
@@ -28,100 +73,106 @@ class BaseDescriptor:
         return attribute_value
 
     def __set__(self, instance, value):
+        setattr(instance, self.name, self.validate(value))
+
+    def validate(self, value):
+        """Check a field value and return the value to store."""
         if not isinstance(value, self.type):
-            raise TypeError(f"{self.name} must be {self.type}")
+            raise TypeError(self.type_error)
 
         if not self.nullable and not value:
-            raise TypeError(f"{self.name} can not be empty.")
+            raise TypeError(self.empty_error)
 
-        setattr(instance, self.name, value)
+        return value
 
 
 class EmailField(BaseDescriptor):
-    def __set__(self, instance, value):
+    def validate(self, value):
         if not isinstance(value, self.type):
-            raise TypeError(f"{self.name} must be {self.type}")
+            raise TypeError(self.type_error)
 
         if not self.nullable and not value:
-            raise TypeError(f"{self.name} can not be empty.")
+            raise TypeError(self.empty_error)
 
         if value and "@" not in value:
             raise TypeError(f"{self.name} should contain a symbol '@'.")
 
-        setattr(instance, self.name, value)
+        return value
 
 
 class ClientIdsField(BaseDescriptor):
-    def __set__(self, instance, value):
+    def validate(self, value):
         if not isinstance(value, self.type):
-            raise TypeError(f"{self.name} must be {self.type}")
+            raise TypeError(self.type_error)
 
         if not self.nullable and not value:
-            raise TypeError(f"{self.name} can not be empty.")
+            raise TypeError(self.empty_error)
 
-        if not all({isinstance(i, int) for i in value}):
+        if not all(isinstance(i, int) for i in value):
             raise TypeError(f"All client ids should be integers.")
 
-        setattr(instance, self.name, value)
+        return value
 
 
 class DateField(BaseDescriptor):
-    def __set__(self, instance, value):
+    def validate(self, value):
         if not isinstance(value, self.type):
-            raise TypeError(f"{self.name} must be {self.type}")
+            raise TypeError(self.type_error)
 
         if not self.nullable and not value:
-            raise TypeError(f"{self.name} can not be empty.")
+            raise TypeError(self.empty_error)
 
         field_date = None
         if value:
             try:
-                field_date = datetime.strptime(value, "%d.%m.%Y")
+                field_date = parse_date(value)
             except ValueError:
-                err_msg = "{} must be a string containing a date as DD.MM.YYYY"
-                raise TypeError(err_msg.format(self.name))
+                raise TypeError(DATE_ERROR.format(self.name))
 
-        setattr(instance, self.name, field_date)
+        return field_date
 
 
 class BirthdayField(BaseDescriptor):
-    def __set__(self, instance, value):
+    def validate(self, value):
         if not isinstance(value, self.type):
-            raise TypeError(f"{self.name} must be {self.type}")
+            raise TypeError(self.type_error)
 
         if not self.nullable and not value:
-            raise TypeError(f"{self.name} can not be empty.")
+            raise TypeError(self.empty_error)
 
         birthday = None
         if value:
             try:
-                birthday = datetime.strptime(value, "%d.%m.%Y")
+                birthday = parse_date(value)
             except ValueError:
-                err_msg = "{} must be a string containing a date as DD.MM.YYYY"
-                raise TypeError(err_msg.format(self.name))
+                raise TypeError(DATE_ERROR.format(self.name))
 
-        current_datetime = datetime.now()
-        limit_date = current_datetime.replace(year=current_datetime.year - 70)
-        if birthday < limit_date:
+        # A person born on the day MAX_AGE years ago is already too old.
+        if birthday < get_birthday_limit():
             raise TypeError("Person age should be less than 70 years.")
 
-        setattr(instance, self.name, birthday)
+        return birthday
 
 
 class GenderField(BaseDescriptor):
-    def __set__(self, instance, value):
+    allowed_values = (0, 1, 2)
+
+    def __init__(self, name: str, required: bool, nullable: bool, type_class):
+        BaseDescriptor.__init__(self, name, required, nullable, type_class)
+        option_description = " or ".join([str(v) for v in self.allowed_values])
+        self.value_error = f"{self.name} should be {option_description}."
+
+    def validate(self, value):
         if not isinstance(value, self.type):
-            raise TypeError(f"{self.name} must be {self.type}")
+            raise TypeError(self.type_error)
 
         if not self.nullable and not value:
-            raise TypeError(f"{self.name} can not be empty.")
+            raise TypeError(self.empty_error)
 
-        allowed_values = [0, 1, 2]
-        if value not in allowed_values:
-            option_description = " or ".join([str(v) for v in allowed_values])
-            raise TypeError(f"{self.name} should be {option_description}.")
+        if value not in self.allowed_values:
+            raise TypeError(self.value_error)
 
-        setattr(instance, self.name, value)
+        return value
 
 
 class PhoneField(BaseDescriptor):
@@ -138,13 +189,15 @@ class PhoneField(BaseDescriptor):
             raise TypeError(err_msg)
 
         self.type = allowed_types
+        self.types = tuple(allowed_types)
+        self.type_error = f"{self.name} must be {self.allowed_types_str}"
 
-    def __set__(self, instance, value):
-        if not any([isinstance(value, typ) for typ in self.type]):
-            raise TypeError(f"{self.name} must be {self.allowed_types_str}")
+    def validate(self, value):
+        if not isinstance(value, self.types):
+            raise TypeError(self.type_error)
 
         if not self.nullable and not value:
-            raise TypeError(f"{self.name} can not be empty.")
+            raise TypeError(self.empty_error)
 
         if value:
             if str(value)[0] != "7":
@@ -152,28 +205,102 @@ class PhoneField(BaseDescriptor):
             if len(str(value)) != 11:
                 raise TypeError("A phone number should consist of 11 digits.")
 
-        setattr(instance, self.name, value)
+        return value
 
     @property
     def allowed_types_str(self) -> str:
         return " or ".join([str(typ) for typ in self.type])
 
 
-class ClientsInterestsRequest:
+class RequestMeta(type):
+    """Compile a validation plan of a request class at its creation.
+
+    The field values of a request are kept in slots, so request instances
+    have no __dict__.
+    """
+    def __new__(mcs, name, bases, namespace):
+        fields = [
+            (n, a) for n, a in namespace.items() if isinstance(a, BaseDescriptor)
+        ]
+        namespace["__slots__"] = tuple(a.name for _, a in fields)
+        cls = super().__new__(mcs, name, bases, namespace)
+        plan = [step for base in bases for step in getattr(base, "_plan", ())]
+        loads = [load for base in bases for load in getattr(base, "_loads", ())]
+        for field_name, field in fields:
+            slot = getattr(cls, field.name)
+            loads.append((field_name, slot.__get__))
+            missing_error = f"Request does not contain the field '{field_name}'"
+            plan.append((
+                field_name,
+                missing_error if field.required else None,
+                field.validate,
+                slot.__set__,
+            ))
+        cls._plan = tuple(plan)
+        cls._loads = tuple(loads)
+        return cls
+
+
+class Request(metaclass=RequestMeta):
+    @classmethod
+    def from_body(cls, request_body):
+        """Return an error message and a request filled from a request body.
+
+        The request is None if the body is invalid.
+        """
+        request = cls()
+        for field_name, missing_error, validate, store in cls._plan:
+            try:
+                value = request_body[field_name]
+            except KeyError:
+                if missing_error:
+                    return missing_error, None
+                continue
+            try:
+                store(request, validate(value))
+            except TypeError as exception:
+                return str(exception), None
+
+        return None, request
+
+    def to_kwargs(self) -> dict:
+        """Return the values of the fields set in the request by field names."""
+        kwargs = {}
+        for field_name, load in self._loads:
+            try:
+                kwargs[field_name] = load(self)
+            except AttributeError:
+                continue
+        return kwargs
+
+
+class ClientsInterestsRequest(Request):
     client_ids = ClientIdsField("client_ids", True, False, list)
     date = DateField("date", False, True, str)
 
 
-class OnlineScoreRequest:
+class OnlineScoreRequest(Request):
     first_name = BaseDescriptor("first_name", False, True, str)
     last_name = BaseDescriptor("last_name", False, True, str)
     email = EmailField("email", False, True, str)
     phone = PhoneField("phone", False, True, [str, int])
     birthday = BirthdayField("birthday", False, True, str)
     gender = GenderField("gender", False, True, int)
+    model = BaseDescriptor("model", False, True, str)
+
+
+class BatchOnlineScoreRequest(Request):
+    items = BaseDescriptor("items", True, False, list)
+
+
+class ProfileRequest(Request):
+    action = BaseDescriptor("action", True, False, str)
+    mode = BaseDescriptor("mode", False, True, str)
+    requests = BaseDescriptor("requests", False, True, int)
+    seconds = BaseDescriptor("seconds", False, True, (int, float))
 
 
-class MethodRequest:
+class MethodRequest(Request):
     account = BaseDescriptor("account", False, True, str)
     login = BaseDescriptor("login", True, True, str)
     token = BaseDescriptor("token", True, True, str)
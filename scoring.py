@@ -1,19 +1,381 @@
-import random
-
-
-def get_score(store, phone, email, birthday=None, gender=None, first_name=None, last_name=None):
-    score = 0
-    if phone:
-        score += 1.5
-    if email:
-        score += 1.5
-    if birthday and gender:
-        score += 1.5
-    if first_name and last_name:
-        score += 0.5
+import functools
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+import models
+
+SCORE_CACHE_SIZE = 10000
+SCORE_CACHE_TTL = 60 * 60
+SCORE_CACHE_TIMEOUT = 0.05
+INTERESTS_CHUNK_SIZE = 500
+INTERESTS_RESULT_TTL = 1.0
+INTERESTS_RESULT_SIZE = 100000
+INTERESTS = (
+    "cars", "pets", "travel", "hi-tech", "sport", "music", "books", "tv",
+    "cinema", "geek", "otus",
+)
+INTERESTS_SEED = 0
+MASK64 = 2 ** 64 - 1
+
+
+class ScoreCache:
+    """Read-through score cache: an in-process LRU in front of the store cache.
+
+    Scores found in the store cache are kept in the LRU as well. Entries of
+    the LRU expire after the same TTL as the ones of the store cache.
+    """
+
+    def __init__(self, size: int, ttl: float, timeout: float):
+        self.size = size
+        self.ttl = ttl
+        self.timeout = timeout
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.local_hits = 0
+        self.store_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(phone, email, birthday, gender, first_name, last_name, model_key) -> str:
+        key_parts = [
+            model_key,
+            str(phone or ""),
+            (email or "").lower(),
+            birthday.strftime("%Y%m%d") if birthday else "",
+            "" if gender is None else str(gender),
+            first_name or "",
+            last_name or "",
+        ]
+        key_hash = hashlib.md5("\x1f".join(key_parts).encode()).hexdigest()
+        return "uid:" + key_hash
+
+    def get_local(self, key: str):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                score, expires_at = entry
+                if expires_at > time.monotonic():
+                    self.entries.move_to_end(key)
+                    self.local_hits += 1
+                    return score
+                del self.entries[key]
+        return None
+
+    def set_local(self, key: str, score):
+        with self.lock:
+            self.entries[key] = (score, time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def get(self, store, key: str):
+        score = self.get_local(key)
+        if score is not None:
+            return score
+
+        cache_get = getattr(store, "cache_get", None)
+        if cache_get is not None:
+            score = cache_get(key, timeout=self.timeout)
+        if score is not None:
+            self.set_local(key, score)
+            with self.lock:
+                self.store_hits += 1
+        else:
+            with self.lock:
+                self.misses += 1
+        return score
+
+    def set(self, store, key: str, score):
+        self.set_local(key, score)
+        cache_set = getattr(store, "cache_set", None)
+        if cache_set is not None:
+            cache_set(key, score, self.ttl, timeout=self.timeout)
+
+    def lookups(self) -> dict:
+        """Return numbers of lookups by the way they were served."""
+        with self.lock:
+            return {
+                "local_hits": self.local_hits,
+                "store_hits": self.store_hits,
+                "misses": self.misses,
+            }
+
+    def stats(self) -> dict:
+        with self.lock:
+            size = len(self.entries)
+        return {**self.lookups(), "size": size}
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.local_hits = self.store_hits = self.misses = 0
+
+
+score_cache = ScoreCache(SCORE_CACHE_SIZE, SCORE_CACHE_TTL, SCORE_CACHE_TIMEOUT)
+
+
+class Flight:
+    """A fetch of a value in progress, awaited by the threads sharing it."""
+    __slots__ = ("done", "value", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class SingleFlight:
+    """De-duplication of concurrent fetches of the same keys.
+
+    A thread asking for a key that another thread is fetching waits for that
+    fetch instead of starting its own. Fetched values are served for `ttl`
+    seconds more, so a burst of requests for the same keys costs one fetch.
+    """
+
+    def __init__(self, ttl: float, size: int):
+        self.ttl = ttl
+        self.size = size
+        self.flights = {}
+        self.results = OrderedDict()
+        self.lock = threading.Lock()
+        self.fetched = 0
+        self.shared = 0
+        self.recent = 0
+
+    def get_many(self, keys, fetch_many) -> list:
+        """Return values of keys, fetching the new ones by one fetch_many call.
+
+        fetch_many gets a list of keys and returns a list of their values.
+        """
+        values = {}
+        own = {}
+        awaited = {}
+        now = time.monotonic()
+        with self.lock:
+            for key in keys:
+                if key in values or key in own or key in awaited:
+                    continue
+                result = self.results.get(key)
+                if result is not None and result[1] > now:
+                    values[key] = result[0]
+                    self.recent += 1
+                    continue
+                flight = self.flights.get(key)
+                if flight is not None:
+                    awaited[key] = flight
+                    self.shared += 1
+                else:
+                    own[key] = self.flights[key] = Flight()
+            self.fetched += len(own)
+
+        # Own keys are fetched before waiting for the other threads, so
+        # threads waiting for each other's keys can not deadlock.
+        if own:
+            try:
+                fetched = fetch_many(list(own))
+            except Exception as exception:
+                self.finish(own, None, exception)
+                raise
+            values.update(zip(own, fetched))
+            self.finish(own, values, None)
+
+        for key, flight in awaited.items():
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            values[key] = flight.value
+        return [values[key] for key in keys]
+
+    def finish(self, flights: dict, values, error):
+        """Publish results of fetched keys and wake up the waiting threads."""
+        now = time.monotonic()
+        expires_at = now + self.ttl
+        with self.lock:
+            for key, flight in flights.items():
+                del self.flights[key]
+                if error is None:
+                    flight.value = values[key]
+                    self.results[key] = (flight.value, expires_at)
+                    self.results.move_to_end(key)
+                else:
+                    flight.error = error
+                flight.done.set()
+            # Results expire in the order of insertion.
+            while self.results and (
+                    len(self.results) > self.size
+                    or next(iter(self.results.values()))[1] <= now
+            ):
+                self.results.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "fetched": self.fetched,
+                "shared": self.shared,
+                "recent": self.recent,
+            }
+
+    def clear(self):
+        with self.lock:
+            self.results.clear()
+            self.fetched = self.shared = self.recent = 0
+
+
+interests_flight = SingleFlight(INTERESTS_RESULT_TTL, INTERESTS_RESULT_SIZE)
+
+
+def get_score(store, phone, email, birthday=None, gender=None, first_name=None, last_name=None, model=None):
+    """Return a score of a lead by a models.Model, the default one if None."""
+    if model is None:
+        model = models.registry.get()
+    key = score_cache.make_key(
+        phone, email, birthday, gender, first_name, last_name, model.key
+    )
+    score = score_cache.get(store, key)
+    if score is None:
+        score = model.score(phone, email, birthday, gender, first_name, last_name)
+        score_cache.set(store, key, score)
     return score
 
 
+def mix64(x: int) -> int:
+    """Return the SplitMix64 hash of a 64-bit integer."""
+    x = (x + 0x9E3779B97F4A7C15) & MASK64
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & MASK64
+    return x ^ (x >> 31)
+
+
+def sample_interests(cid) -> list:
+    """Return two different interests of a client picked by a hash of its id.
+
+    A client gets the same interests on every call with the same seed, and
+    no shared random generator is involved.
+    """
+    h = mix64((cid ^ INTERESTS_SEED) & MASK64)
+    first = h % len(INTERESTS)
+    second = (first + 1 + (h >> 32) % (len(INTERESTS) - 1)) % len(INTERESTS)
+    return [INTERESTS[first], INTERESTS[second]]
+
+
+@functools.lru_cache(maxsize=None)
+def get_numpy():
+    """Return NumPy, None if it is not installed.
+
+    NumPy takes longer to import than the whole API, so it is imported on the
+    first batch, not by every short-lived worker.
+    """
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+def sample_interests_many(cids) -> list:
+    """Return sample_interests of many clients computed at once."""
+    np = get_numpy() if cids else None
+    if np is None:
+        return [sample_interests(cid) for cid in cids]
+
+    u64 = np.uint64
+    x = np.fromiter(
+        ((cid ^ INTERESTS_SEED) & MASK64 for cid in cids),
+        dtype=u64,
+        count=len(cids)
+    )
+    # Operations on uint64 arrays wrap around like the masked ones of mix64.
+    x = x + u64(0x9E3779B97F4A7C15)
+    x = (x ^ (x >> u64(30))) * u64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> u64(27))) * u64(0x94D049BB133111EB)
+    h = x ^ (x >> u64(31))
+    size = u64(len(INTERESTS))
+    first = h % size
+    second = (first + u64(1) + (h >> u64(32)) % (size - u64(1))) % size
+    return [
+        [INTERESTS[a], INTERESTS[b]]
+        for a, b in zip(first.tolist(), second.tolist())
+    ]
+
+
 def get_interests(store, cid):
-    interests = ["cars", "pets", "travel", "hi-tech", "sport", "music", "books", "tv", "cinema", "geek", "otus"]
-    return random.sample(interests, 2)
+    if store is not None:
+        stored_interests = get_stored_interests(store, [cid])[0]
+        if stored_interests:
+            return stored_interests
+    return sample_interests(cid)
+
+
+def get_stored_interests(store, cids) -> list:
+    """Return stored interests of clients, None for unknown clients.
+
+    Concurrent lookups of the same clients share one store fetch.
+    """
+    keys = [f"i:{cid}" for cid in cids]
+    if store is None:
+        return [None] * len(keys)
+    get_many = getattr(store, "get_many", None)
+    if get_many is None:
+        def get_many(many_keys):
+            return [store.get(k) for k in many_keys]
+    return interests_flight.get_many(keys, get_many)
+
+
+def get_interests_many(store, cids, chunk_size=None):
+    """Yield pairs of a client id and client interests.
+
+    The interests are fetched from the store in chunks of `chunk_size`
+    clients, each chunk in one round trip. Interests of the clients missing
+    in the store are sampled for the whole chunk at once.
+    """
+    chunk_size = chunk_size or INTERESTS_CHUNK_SIZE
+    for start in range(0, len(cids), chunk_size):
+        chunk = cids[start:start + chunk_size]
+        stored = get_stored_interests(store, chunk)
+        missing = [cid for cid, interests in zip(chunk, stored) if not interests]
+        sampled = iter(sample_interests_many(missing))
+        for cid, interests in zip(chunk, stored):
+            yield cid, interests or next(sampled)
+
+
+def get_scores(store, requests):
+    """Return scores of many requests, each given as get_score arguments.
+
+    Requests scored by the same model are evaluated at once.
+    """
+    groups = {}
+    for index, r in enumerate(requests):
+        groups.setdefault(r.get("model"), []).append(index)
+    if len(groups) == 1:
+        return (next(iter(groups)) or models.registry.get()).score_rows(requests)
+    scores = [None] * len(requests)
+    for model, indexes in groups.items():
+        group = [requests[i] for i in indexes]
+        group_scores = (model or models.registry.get()).score_rows(group)
+        for index, score in zip(indexes, group_scores):
+            scores[index] = score
+    return scores
+
+
+async def get_score_async(store, phone, email, birthday=None, gender=None, first_name=None, last_name=None, model=None):
+    if model is None:
+        model = models.registry.get()
+    key = score_cache.make_key(
+        phone, email, birthday, gender, first_name, last_name, model.key
+    )
+    score = score_cache.get_local(key)
+    if score is not None:
+        return score
+    if store is None:
+        return get_score(store, phone, email, birthday, gender, first_name, last_name, model)
+    # asyncio is already loaded when a coroutine runs, importing it at the
+    # module level would only slow down the import by the threaded servers.
+    import asyncio
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        None,
+        get_score,
+        store, phone, email, birthday, gender, first_name, last_name, model
+    )
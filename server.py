@@ -0,0 +1,658 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""HTTP servers of the scoring API and the command line interface.
+
+The request handling logic lives in `api`, this module adds the transport,
+so batch jobs and workers importing `api` do not load the HTTP stack.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import math
+import os
+import selectors
+import signal
+import socket
+import sys
+import threading
+import time
+import uuid
+from functools import partial
+from itertools import chain
+from time import perf_counter
+from optparse import OptionParser
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+from admission import ADMITTED, REJECTED, AdmissionController, RateLimiter
+from capture import TrafficRecorder
+from api import (
+    BAD_REQUEST, INTERNAL_ERROR, MAX_BODY_SIZE, NOT_FOUND, OK,
+    REQUEST_ENTITY_TOO_LARGE, SERVICE_UNAVAILABLE, TOO_MANY_REQUESTS,
+    InterestsStream, get_method_label, make_response, method_handler,
+)
+import codec
+import logs
+import metrics
+import models
+import profiler
+import scoring
+from store import Store, UnixSocketConnection
+
+THREAD_MODE = "thread"
+PREFORK_MODE = "prefork"
+ASYNC_MODE = "async"
+SERVER_MODES = (THREAD_MODE, PREFORK_MODE, ASYNC_MODE)
+KEEPALIVE_TIMEOUT = 15
+KEEPALIVE_REQUESTS = 1000
+REJECTION_BODY = codec.dumps(make_response(None, SERVICE_UNAVAILABLE))
+REJECTION = (
+    b"HTTP/1.1 503 Service Unavailable\r\n"
+    b"Content-Type: application/json\r\n"
+    b"Content-Length: %d\r\n"
+    b"Retry-After: 1\r\n"
+    b"Connection: close\r\n"
+    b"\r\n%s" % (len(REJECTION_BODY), REJECTION_BODY)
+)
+
+
+class MainHTTPHandler(BaseHTTPRequestHandler):
+    """Handler of persistent HTTP/1.1 connections.
+
+    A connection is closed after `timeout` seconds without requests or after
+    `max_keepalive_requests` responses. A server watching idle connections
+    gets a connection back when no request is buffered, see
+    ThreadPoolHTTPServer.
+    """
+    protocol_version = "HTTP/1.1"
+    timeout = KEEPALIVE_TIMEOUT
+    max_keepalive_requests = KEEPALIVE_REQUESTS
+    # Headers and a body are written separately, with Nagle's algorithm the
+    # body would wait for the ACK of the headers on a reused connection.
+    disable_nagle_algorithm = True
+    router = {
+        "method": method_handler
+    }
+    store = None
+    max_body_size = MAX_BODY_SIZE
+    rate_limiter = None
+    recorder = None
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.served = 0
+        self.parked = False
+
+    def handle(self):
+        self.parked = False
+        self.handle_one_request()
+        watched = getattr(self.server, "watches_idle_connections", False)
+        while not self.close_connection:
+            if watched and not self.is_request_buffered():
+                self.parked = not self.close_connection
+                return
+            self.handle_one_request()
+
+    def resume(self):
+        """Handle requests of a connection given back to the server."""
+        try:
+            self.handle()
+        finally:
+            self.finish()
+
+    def finish(self):
+        # Files of a parked connection are used by the next requests.
+        if not self.parked:
+            BaseHTTPRequestHandler.finish(self)
+
+    def is_request_buffered(self) -> bool:
+        """Check without blocking whether a next request has arrived."""
+        self.connection.setblocking(False)
+        try:
+            return bool(self.rfile.peek(1))
+        except OSError:
+            self.close_connection = True
+            return False
+        finally:
+            self.connection.settimeout(self.timeout)
+
+    def send_response(self, code, message=None):
+        BaseHTTPRequestHandler.send_response(self, code, message)
+        self.served += 1
+        if (
+                self.served >= self.max_keepalive_requests
+                or getattr(self.server, "closing", False)
+        ):
+            self.close_connection = True
+        if self.close_connection:
+            self.send_header("Connection", "close")
+
+    def get_request_id(self, headers):
+        return headers.get("HTTP_X_REQUEST_ID", uuid.uuid4().hex)
+
+    def do_GET(self):
+        if self.path.strip("/") != "metrics" or not metrics.enabled:
+            body = codec.dumps(make_response(None, NOT_FOUND))
+            content_type = "application/json"
+            self.send_response(NOT_FOUND)
+        else:
+            body = metrics.registry.render().encode()
+            content_type = metrics.CONTENT_TYPE
+            self.send_response(OK)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        response, code = {}, OK
+        timer = metrics.start_timer()
+        context = {"request_id": self.get_request_id(self.headers)}
+        logs.start_request()
+        logging.info("Request handling started. %s", context)
+        request = None
+        try:
+            content_length = int(self.headers["Content-Length"])
+        except (TypeError, ValueError):
+            content_length = -1
+        if content_length > self.max_body_size:
+            logging.error("Request body is too large: %s", content_length)
+            # The body is left unread, so the connection can not be reused.
+            self.close_connection = True
+            code = REQUEST_ENTITY_TOO_LARGE
+        else:
+            try:
+                data_string = codec.read_body(self.rfile, content_length)
+                if timer:
+                    timer.mark("read")
+            except:
+                logging.error("Failed to read request body.")
+                # The end of the body is unknown, so is the next request.
+                self.close_connection = True
+                code = BAD_REQUEST
+            else:
+                try:
+                    request = codec.loads(data_string)
+                    if timer:
+                        timer.mark("parse")
+                except:
+                    logging.error("Failed to parse request body.")
+                    code = BAD_REQUEST
+
+        captured_at = None
+        if request:
+            path = self.path.strip("/")
+            if logging.getLogger().isEnabledFor(logging.INFO):
+                logging.info(
+                    "%s: %s %s",
+                    self.path,
+                    bytes(data_string),
+                    context["request_id"]
+                )
+            if path not in self.router:
+                code = NOT_FOUND
+            else:
+                handle = self.router[path]
+                if profiler.armed:
+                    handle = profiler.wrap(handle)
+                if self.recorder is not None and self.recorder.sample():
+                    captured_at = perf_counter()
+                try:
+                    response, code = handle(
+                        {
+                            "body": request,
+                            "headers": self.headers,
+                            "timer": timer,
+                            "rate_limiter": self.rate_limiter,
+                        },
+                        context,
+                        self.store
+                    )
+                except Exception as e:
+                    logging.exception("Unexpected error: %s", e)
+                    code = INTERNAL_ERROR
+                if captured_at is not None:
+                    self.recorder.record(
+                        request,
+                        response,
+                        code,
+                        perf_counter() - captured_at
+                    )
+
+        r = make_response(response, code)
+        context.update(r)
+        # Failed requests are warnings, so sampling does not drop them.
+        logging.log(logging.INFO if code == OK else logging.WARNING, context)
+        if isinstance(response, InterestsStream):
+            self.write_stream(response)
+        else:
+            body = codec.dumps(r)
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            if code == TOO_MANY_REQUESTS:
+                self.send_header("Retry-After", "1")
+            self.end_headers()
+            self.wfile.write(body)
+        if timer:
+            timer.mark("serialize")
+            metrics.record(timer, get_method_label(request), code)
+        return
+
+    def write_stream(self, stream: InterestsStream):
+        """Write a successful response with a streamed body.
+
+        The body is sent with chunked transfer encoding if both sides speak
+        HTTP/1.1, otherwise the end of the body is marked by closing the
+        connection.
+        """
+        chunked = (
+            self.protocol_version >= "HTTP/1.1"
+            and self.request_version >= "HTTP/1.1"
+        )
+        if not chunked:
+            self.close_connection = True
+        self.send_response(OK)
+        self.send_header("Content-Type", "application/json")
+        if chunked:
+            self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        parts = chain([b'{"response": '], stream.iter_json(), [b', "code": 200}'])
+        try:
+            for part in parts:
+                if chunked:
+                    part = b"%x\r\n%s\r\n" % (len(part), part)
+                self.wfile.write(part)
+            if chunked:
+                self.wfile.write(b"0\r\n\r\n")
+        except Exception as e:
+            # The status is already sent: a client detects the failure by a
+            # missing end of the body.
+            logging.exception("Failed to stream a response: %s", e)
+            self.close_connection = True
+
+
+class ThreadPoolHTTPServer(HTTPServer):
+    """HTTP server handling requests in a fixed pool of worker threads.
+
+    Connections waiting for a request, new ones and idle persistent ones, are
+    watched by a selector in a thread of its own, and a connection is handed
+    to a worker when a request arrives. So idle connections do not hold
+    workers. On shutdown idle connections are closed, busy ones are closed
+    after their responses.
+
+    A connection with a request goes through the admission controller: it
+    takes a slot of a worker, waits for one in the bounded queue of the
+    controller or gets the code 503 at once.
+    """
+    watches_idle_connections = True
+
+    def __init__(self, server_address, handler_class, workers, admission=None):
+        HTTPServer.__init__(self, server_address, handler_class)
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers,
+            thread_name_prefix="http-worker"
+        )
+        self.admission = admission or AdmissionController(
+            workers,
+            sys.maxsize,
+            math.inf
+        )
+        # Admitted connections over the number of workers would wait in the
+        # unbounded queue of the executor, out of sight of the controller.
+        self.admission.max_concurrent = min(self.admission.max_concurrent, workers)
+        self.closing = False
+        self.lock = threading.Lock()
+        # Connections given back by workers, the selector is used by the
+        # watcher thread only.
+        self.returned = []
+        self.selector = selectors.DefaultSelector()
+        self.wakeup, self.waker = socket.socketpair()
+        self.selector.register(self.wakeup, selectors.EVENT_READ)
+        self.watcher = threading.Thread(
+            target=self.watch,
+            name="http-idle",
+            daemon=True
+        )
+        self.watcher.start()
+
+    def process_request(self, request, client_address):
+        self.give_back(request, client_address, None)
+
+    def give_back(self, request, client_address, handler):
+        """Watch a connection until its next request arrives."""
+        with self.lock:
+            closing = self.closing
+            if not closing:
+                self.returned.append((request, client_address, handler))
+        if closing:
+            self.close_idle(request, handler)
+        else:
+            self.waker.send(b"\0")
+
+    def watch(self):
+        timeout = self.RequestHandlerClass.timeout
+        # Deadlines of idle connections, in the order they were given back.
+        idle = {}
+        while True:
+            deadlines = [self.admission.next_deadline() or math.inf]
+            if idle:
+                deadlines.append(next(iter(idle.values())))
+            wait = None
+            if min(deadlines) < math.inf:
+                wait = max(0, min(deadlines) - time.monotonic())
+            for key, _ in self.selector.select(wait):
+                if key.fileobj is self.wakeup:
+                    self.wakeup.recv(4096)
+                    continue
+                self.selector.unregister(key.fileobj)
+                del idle[key.fileobj]
+                if is_closed(key.fileobj):
+                    self.close_idle(key.fileobj, key.data[1])
+                else:
+                    self.admit((key.fileobj, *key.data))
+
+            with self.lock:
+                returned, self.returned = self.returned, []
+                closing = self.closing
+            now = time.monotonic()
+            for request, client_address, handler in returned:
+                self.selector.register(
+                    request,
+                    selectors.EVENT_READ,
+                    (client_address, handler)
+                )
+                idle[request] = now + timeout
+            for connection in self.admission.expire(math.inf if closing else None):
+                self.reject(*connection)
+            if closing:
+                expired = list(idle)
+            else:
+                expired = []
+                for request, deadline in idle.items():
+                    if deadline > now:
+                        break
+                    expired.append(request)
+            for request in expired:
+                client_address, handler = self.selector.unregister(request).data
+                del idle[request]
+                self.close_idle(request, handler)
+            if closing:
+                return
+
+    def admit(self, connection):
+        state = self.admission.admit(connection)
+        if state == ADMITTED:
+            self.executor.submit(self.process_request_thread, connection)
+        elif state == REJECTED:
+            self.reject(*connection)
+
+    def reject(self, request, client_address, handler):
+        """Answer 503 to a connection without handling its request."""
+        logging.warning(
+            "Request from %s is rejected: the server is overloaded.",
+            client_address
+        )
+        metrics.record(metrics.start_timer(), "", SERVICE_UNAVAILABLE)
+        request.setblocking(False)
+        try:
+            # Closing a socket with unread data resets the connection, and
+            # the client may lose the response.
+            while request.recv(65536):
+                pass
+        except OSError:
+            pass
+        try:
+            request.send(REJECTION)
+        except OSError:
+            pass
+        self.close_idle(request, handler)
+
+    def close_idle(self, request, handler):
+        """Close a connection no worker is handling."""
+        if handler is not None:
+            # Files of a parked handler keep the socket open.
+            handler.rfile.close()
+            handler.wfile.close()
+        self.shutdown_request(request)
+
+    def process_request_thread(self, connection):
+        """Handle connections while the admission controller hands them over."""
+        while connection is not None:
+            self.handle_connection(*connection)
+            connection, expired = self.admission.release()
+            for expired_connection in expired:
+                self.reject(*expired_connection)
+
+    def handle_connection(self, request, client_address, handler):
+        try:
+            if handler is None:
+                handler = self.RequestHandlerClass(request, client_address, self)
+            else:
+                handler.resume()
+        except Exception:
+            self.handle_error(request, client_address)
+        else:
+            if handler.parked:
+                self.give_back(request, client_address, handler)
+                return
+        self.shutdown_request(request)
+
+    def shutdown(self):
+        self.stop_watching()
+        HTTPServer.shutdown(self)
+
+    def stop_watching(self):
+        """Close idle connections, responses from now on close theirs."""
+        with self.lock:
+            self.closing = True
+        self.waker.send(b"\0")
+
+    def server_close(self):
+        HTTPServer.server_close(self)
+        self.stop_watching()
+        self.watcher.join()
+        self.executor.shutdown(wait=True)
+        self.selector.close()
+        self.wakeup.close()
+        self.waker.close()
+
+
+def is_closed(request) -> bool:
+    """Check whether a readable connection is closed by the client."""
+    try:
+        return not request.recv(1, socket.MSG_PEEK)
+    except OSError:
+        return True
+
+
+def install_shutdown_handler(server):
+    """Stop the serve loop on SIGINT/SIGTERM, letting requests in flight finish."""
+    def handle_signal(signum, frame):
+        logging.info(f"Got signal {signum}, shutting down.")
+        # shutdown() blocks until serve_forever() returns, so it can not be
+        # called from the thread running the loop.
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGINT, handle_signal)
+    signal.signal(signal.SIGTERM, handle_signal)
+
+
+def stop_recorder(server):
+    recorder = server.RequestHandlerClass.recorder
+    if recorder is not None:
+        recorder.stop()
+
+
+def serve_threaded(server):
+    install_shutdown_handler(server)
+    server.serve_forever()
+    server.server_close()
+    stop_recorder(server)
+
+
+def serve_prefork(server, workers):
+    """Fork worker processes accepting connections on the same socket."""
+    children = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            install_shutdown_handler(server)
+            server.serve_forever()
+            server.server_close()
+            stop_recorder(server)
+            logging.shutdown()
+            os._exit(0)
+        children.append(pid)
+
+    def forward_signal(signum, frame):
+        logging.info(f"Got signal {signum}, stopping workers.")
+        for child_pid in children:
+            try:
+                os.kill(child_pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGINT, forward_signal)
+    signal.signal(signal.SIGTERM, forward_signal)
+    for child_pid in children:
+        os.waitpid(child_pid, 0)
+    server.server_close()
+
+
+def main():
+    op = OptionParser()
+    op.add_option("-p", "--port", action="store", type=int, default=8080)
+    op.add_option("-l", "--log", action="store", default=None)
+    op.add_option("--log-mode", action="store", type="choice",
+                  choices=("sync", "async"), default="sync",
+                  help="Write JSON log records from a background thread")
+    op.add_option("--log-sample", action="store", type=float, default=1.0,
+                  help="Share of INFO records written in the async log mode")
+    op.add_option("--log-queue", action="store", type=int,
+                  default=logs.QUEUE_SIZE,
+                  help="Size of the log queue in the async log mode")
+    op.add_option("-w", "--workers", action="store", type=int, default=os.cpu_count())
+    op.add_option("-m", "--mode", action="store", type="choice",
+                  choices=SERVER_MODES, default=THREAD_MODE)
+    op.add_option("-s", "--store", action="store", default=None,
+                  help="Unix socket of the key-value storage")
+    op.add_option("--store-pool", action="store", type=int, default=10)
+    op.add_option("--store-timeout", action="store", type=float, default=1.0)
+    op.add_option("--store-retries", action="store", type=int, default=3)
+    op.add_option("--interests-chunk", action="store", type=int,
+                  default=scoring.INTERESTS_CHUNK_SIZE,
+                  help="Number of client ids fetched from the store at once")
+    op.add_option("--interests-ttl", action="store", type=float,
+                  default=scoring.INTERESTS_RESULT_TTL,
+                  help="Seconds to share fetched client interests")
+    op.add_option("--max-body", action="store", type=int,
+                  default=MAX_BODY_SIZE,
+                  help="Maximal size of a request body in bytes")
+    op.add_option("--max-concurrent", action="store", type=int, default=0,
+                  help="Maximal number of requests handled at once, 0 for no limit")
+    op.add_option("--queue-size", action="store", type=int, default=0,
+                  help="Maximal number of requests waiting over --max-concurrent")
+    op.add_option("--queue-timeout", action="store", type=float, default=0.1,
+                  help="Seconds a request waits before it is rejected with 503")
+    op.add_option("--rate-limit", action="store", type=float, default=0,
+                  help="Requests per second allowed to a login, 0 for no limit")
+    op.add_option("--rate-burst", action="store", type=int, default=10,
+                  help="Requests a login may send at once over --rate-limit")
+    op.add_option("--keepalive-timeout", action="store", type=float,
+                  default=KEEPALIVE_TIMEOUT,
+                  help="Seconds an idle persistent connection is kept open")
+    op.add_option("--keepalive-requests", action="store", type=int,
+                  default=KEEPALIVE_REQUESTS,
+                  help="Maximal number of requests over one connection")
+    op.add_option("--models", action="store", default=None,
+                  help="JSON file of scoring models, reloaded when it changes")
+    op.add_option("--models-poll", action="store", type=float,
+                  default=models.POLL_INTERVAL,
+                  help="Seconds between checks of the models file")
+    op.add_option("--capture", action="store", default=None,
+                  help="Gzip file to capture sampled requests and responses to")
+    op.add_option("--capture-sample", action="store", type=float, default=0.01,
+                  help="Share of requests to capture")
+    op.add_option("--no-metrics", action="store_false", dest="metrics",
+                  default=True, help="Disable latency metrics")
+    (opts, args) = op.parse_args()
+    if opts.log_mode == "async":
+        logs.setup_async_logging(
+            opts.log,
+            sample_rate=opts.log_sample,
+            queue_size=opts.log_queue
+        )
+    else:
+        logging.basicConfig(
+            filename=opts.log,
+            level=logging.INFO,
+            format="[%(asctime)s] %(levelname).1s %(message)s",
+            datefmt="%Y.%m.%d %H:%M:%S"
+        )
+    logging.info(
+        f"Starting server at {opts.port} ({opts.mode}, {opts.workers} workers, "
+        f"{codec.NAME} codec)"
+    )
+    scoring.INTERESTS_CHUNK_SIZE = opts.interests_chunk
+    scoring.interests_flight.ttl = opts.interests_ttl
+    metrics.enabled = opts.metrics
+    MainHTTPHandler.max_body_size = opts.max_body
+    MainHTTPHandler.timeout = opts.keepalive_timeout
+    if opts.capture:
+        MainHTTPHandler.recorder = TrafficRecorder(
+            opts.capture,
+            opts.capture_sample
+        )
+        MainHTTPHandler.recorder.start()
+    if opts.models:
+        models.registry.load_file(opts.models)
+        models.registry.start_polling(opts.models_poll)
+    MainHTTPHandler.max_keepalive_requests = opts.keepalive_requests
+    admission = None
+    if opts.max_concurrent > 0:
+        admission = AdmissionController(
+            opts.max_concurrent,
+            opts.queue_size,
+            opts.queue_timeout
+        )
+    if opts.rate_limit > 0:
+        MainHTTPHandler.rate_limiter = RateLimiter(
+            opts.rate_limit,
+            opts.rate_burst
+        )
+    if opts.store:
+        # Connections are opened on demand, so prefork workers do not share
+        # sockets of the pool created before the fork.
+        MainHTTPHandler.store = Store(
+            partial(UnixSocketConnection, opts.store, opts.store_timeout),
+            pool_size=opts.store_pool,
+            timeout=opts.store_timeout,
+            retries=opts.store_retries
+        )
+    if opts.mode == ASYNC_MODE:
+        from async_api import serve_async
+        serve_async(
+            "localhost",
+            opts.port,
+            MainHTTPHandler.store,
+            opts.max_body
+        )
+    elif opts.mode == PREFORK_MODE:
+        # A prefork worker serves one connection at a time, an idle
+        # persistent connection would keep it from accepting new ones.
+        MainHTTPHandler.max_keepalive_requests = 1
+        server = HTTPServer(("localhost", opts.port), MainHTTPHandler)
+        serve_prefork(server, opts.workers)
+    else:
+        server = ThreadPoolHTTPServer(
+            ("localhost", opts.port),
+            MainHTTPHandler,
+            opts.workers,
+            admission
+        )
+        serve_threaded(server)
+
+
+if __name__ == "__main__":
+    main()
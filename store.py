@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Key-value storage client and a local stand-in storage server.
+
+The client and the server talk JSON lines over a Unix socket: every command
+is an object with an operation name and a key, every reply is an object with
+a result.
+"""
+
+import json
+import logging
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+from contextlib import contextmanager
+from optparse import OptionParser
+
+
+class StoreError(Exception):
+    pass
+
+
+class UnixSocketConnection:
+    """Connection to a key-value server listening on a Unix socket."""
+
+    def __init__(self, path: str, timeout: float = 1.0):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        try:
+            self.sock.connect(path)
+        except OSError:
+            self.sock.close()
+            raise
+        self.file = self.sock.makefile("rwb")
+
+    def call(self, command: dict, timeout: float):
+        self.sock.settimeout(timeout)
+        self.file.write(json.dumps(command).encode() + b"\n")
+        self.file.flush()
+        line = self.file.readline()
+        if not line:
+            raise StoreError("Connection closed by the storage.")
+        reply = json.loads(line)
+        if "error" in reply:
+            raise StoreError(reply["error"])
+        return reply["result"]
+
+    def close(self):
+        try:
+            self.file.close()
+        finally:
+            self.sock.close()
+
+
+class ConnectionPool:
+    """Bounded pool of connections created on demand."""
+
+    def __init__(self, connect, size: int):
+        self.connect = connect
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(size)
+
+    @contextmanager
+    def connection(self, timeout: float):
+        if not self.slots.acquire(timeout=timeout):
+            raise StoreError("There is no free connection in the pool.")
+        try:
+            try:
+                connection = self.idle.get_nowait()
+            except queue.Empty:
+                connection = self.connect()
+            try:
+                yield connection
+            except BaseException:
+                # The state of the connection is unknown after a failure.
+                connection.close()
+                raise
+            self.idle.put(connection)
+        finally:
+            self.slots.release()
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+class Store:
+    """Key-value storage client sharing a connection pool between threads.
+
+    The methods get/set raise StoreError if the storage is unavailable after
+    all retries. The cache methods never raise: a cache miss is returned
+    instead, and after a failure the cache is not used for
+    `cache_failure_backoff` seconds.
+    """
+
+    def __init__(
+            self,
+            connect,
+            pool_size: int = 10,
+            timeout: float = 1.0,
+            retries: int = 3,
+            backoff: float = 0.1,
+            cache_failure_backoff: float = 5.0
+    ):
+        self.pool = ConnectionPool(connect, pool_size)
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.cache_failure_backoff = cache_failure_backoff
+        self.cache_down_until = 0
+
+    def call(self, command: dict, timeout: float = None, retries: int = None):
+        timeout = self.timeout if timeout is None else timeout
+        retries = self.retries if retries is None else retries
+        for attempt in range(retries + 1):
+            try:
+                with self.pool.connection(timeout) as connection:
+                    return connection.call(command, timeout)
+            except (OSError, ValueError, StoreError) as exception:
+                error = exception
+                logging.warning(
+                    f"Storage call failed (attempt {attempt + 1}): {error}"
+                )
+            if attempt < retries:
+                time.sleep(self.backoff * 2 ** attempt)
+        raise StoreError(f"Storage is unavailable: {error}")
+
+    def get(self, key: str):
+        return self.call({"op": "get", "key": key})
+
+    def get_many(self, keys: list) -> list:
+        """Return values of many keys fetched in one round trip."""
+        return self.call({"op": "mget", "keys": keys})
+
+    def set(self, key: str, value, ttl: float = None):
+        self.call({"op": "set", "key": key, "value": value, "ttl": ttl})
+
+    def cache_call(self, command: dict, timeout: float = None):
+        if time.monotonic() < self.cache_down_until:
+            return None
+        try:
+            return self.call(command, timeout, retries=0)
+        except StoreError:
+            self.cache_down_until = time.monotonic() + self.cache_failure_backoff
+            return None
+
+    def cache_get(self, key: str, timeout: float = None):
+        return self.cache_call({"op": "get", "key": key}, timeout)
+
+    def cache_set(self, key: str, value, ttl: float, timeout: float = None):
+        command = {"op": "set", "key": key, "value": value, "ttl": ttl}
+        self.cache_call(command, timeout)
+
+    def close(self):
+        self.pool.close()
+
+
+class KeyValueHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                command = json.loads(line)
+                operation = command["op"]
+                if operation == "get":
+                    reply = {"result": self.server.get(command["key"])}
+                elif operation == "mget":
+                    keys = command["keys"]
+                    reply = {"result": [self.server.get(k) for k in keys]}
+                elif operation == "set":
+                    self.server.set(
+                        command["key"],
+                        command.get("value"),
+                        command.get("ttl")
+                    )
+                    reply = {"result": None}
+                else:
+                    reply = {"error": f"Unknown operation {operation}"}
+            except (ValueError, KeyError, TypeError) as exception:
+                reply = {"error": f"Invalid command: {exception}"}
+            self.wfile.write(json.dumps(reply).encode() + b"\n")
+
+
+class KeyValueServer(socketserver.ThreadingUnixStreamServer):
+    """In-memory key-value storage server with expiring keys."""
+    daemon_threads = True
+
+    def __init__(self, path: str):
+        socketserver.ThreadingUnixStreamServer.__init__(
+            self,
+            path,
+            KeyValueHandler
+        )
+        self.data = {}
+        self.lock = threading.Lock()
+
+    def get(self, key: str):
+        with self.lock:
+            value, expires_at = self.data.get(key, (None, None))
+            if expires_at is not None and expires_at < time.monotonic():
+                del self.data[key]
+                value = None
+        return value
+
+    def set(self, key: str, value, ttl: float = None):
+        expires_at = None if ttl is None else time.monotonic() + ttl
+        with self.lock:
+            self.data[key] = (value, expires_at)
+
+    def server_close(self):
+        socketserver.ThreadingUnixStreamServer.server_close(self)
+        os.unlink(self.server_address)
+
+    def start(self) -> threading.Thread:
+        """Serve in a background thread of the current process."""
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+
+if __name__ == "__main__":
+    op = OptionParser()
+    op.add_option("-s", "--socket", action="store", default="/tmp/scoring.sock")
+    (opts, args) = op.parse_args()
+    logging.basicConfig(
+        level=logging.INFO,
+        format="[%(asctime)s] %(levelname).1s %(message)s",
+        datefmt="%Y.%m.%d %H:%M:%S"
+    )
+    server = KeyValueServer(opts.socket)
+    logging.info(f"Starting storage at {opts.socket}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
@@ -1,10 +1,34 @@
+import asyncio
 import hashlib
 import datetime
 import functools
+import http.client
+import io
+import itertools
+import json
+import logging
+import os
+import runpy
+import tempfile
+import threading
+import time
 import unittest
 
+import admission
 import api
+import async_api
+import bulk
+import capture
+import codec
+import logs
+import metrics
+import models
+import profiler
+import replay
+import scoring
+import server
 from req import ADMIN_LOGIN
+from store import KeyValueServer, Store, StoreError, UnixSocketConnection
 
 
 def cases(cases):
@@ -47,6 +71,19 @@ class TestSuite(unittest.TestCase):
         _, code = self.get_response(request)
         self.assertEqual(api.FORBIDDEN, code)
 
+    def test_cached_auth(self):
+        api.auth_cache.clear()
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "online_score",
+                   "arguments": {"first_name": "a", "last_name": "b"}}
+        self.set_valid_auth(request)
+        for _ in range(2):
+            _, code = self.get_response(dict(request))
+            self.assertEqual(api.OK, code)
+        self.assertEqual(len(api.auth_cache.verified), 1)
+        wrong_token = request["token"][:-1] + ("1" if request["token"].endswith("0") else "0")
+        _, code = self.get_response({**request, "token": wrong_token})
+        self.assertEqual(api.FORBIDDEN, code)
+
     @cases([
         {"account": "horns&hoofs", "login": "h&f", "method": "online_score"},
         {"account": "horns&hoofs", "login": "h&f", "arguments": {}},
@@ -108,6 +145,56 @@ class TestSuite(unittest.TestCase):
         score = response.get("score")
         self.assertEqual(score, 42)
 
+    def test_batch_score_request(self):
+        items = [
+            {"phone": "79175002040", "email": "stupnikov@otus.ru"},
+            {"phone": "89175002040", "email": "stupnikov@otus.ru"},
+            {"first_name": "a", "last_name": "b"},
+            "not an object",
+        ]
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "batch_online_score",
+                   "arguments": {"items": items}}
+        self.set_valid_auth(request)
+        response, code = self.get_response(request)
+        self.assertEqual(api.OK, code)
+        self.assertEqual(response["scores"], [3.0, None, 0.5, None])
+        self.assertEqual(sorted(response["errors"]), [1, 3])
+        self.assertEqual(self.context.get("nitems"), len(items))
+
+    @cases([
+        {},
+        {"items": []},
+        {"items": {"phone": "79175002040"}},
+    ])
+    def test_invalid_batch_score_request(self, arguments):
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "batch_online_score",
+                   "arguments": arguments}
+        self.set_valid_auth(request)
+        response, code = self.get_response(request)
+        self.assertEqual(api.INVALID_REQUEST, code, arguments)
+        self.assertTrue(len(response))
+
+    def test_birthday_age_limit(self):
+        today = datetime.date.today()
+        oldest_birthday = today.replace(year=today.year - 70)
+        for birthday, code in [
+            (oldest_birthday, api.INVALID_REQUEST),
+            (oldest_birthday + datetime.timedelta(days=1), api.OK),
+        ]:
+            arguments = {"gender": 1, "birthday": birthday.strftime("%d.%m.%Y")}
+            request = {"account": "horns&hoofs", "login": "h&f", "method": "online_score", "arguments": arguments}
+            self.set_valid_auth(request)
+            _, response_code = self.get_response(request)
+            self.assertEqual(code, response_code, arguments)
+
+    def test_request_to_kwargs(self):
+        arguments = {"phone": "79175002040", "email": "stupnikov@otus.ru", "gender": 1, "first_name": ""}
+        err_message, score_req, model = api.validate_score_request(arguments)
+        self.assertIsNone(err_message)
+        self.assertIs(model, models.registry.get())
+        self.assertFalse(hasattr(score_req, "__dict__"))
+        self.assertEqual(arguments, score_req.to_kwargs())
+
     @cases([
         {},
         {"date": "20.07.2017"},
@@ -138,6 +225,614 @@ class TestSuite(unittest.TestCase):
                         for v in response.values()))
         self.assertEqual(self.context.get("nclients"), len(arguments["client_ids"]))
 
+    def test_stage_metrics(self):
+        metrics.registry.clear()
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "online_score",
+                   "arguments": {"first_name": "a", "last_name": "b"}}
+        self.set_valid_auth(request)
+        timer = metrics.StageTimer()
+        _, code = api.method_handler({"body": request, "headers": {}, "timer": timer}, self.context, None)
+        metrics.record(timer, api.get_method_label(request), code)
+        self.assertEqual([s for s, _ in timer.stages], ["validate", "auth", "handle"])
+        rendered = metrics.registry.render()
+        labels = 'stage="auth",method="online_score",code="200"'
+        self.assertIn(f'{metrics.METRIC_NAME}_count{{{labels}}} 1', rendered)
+        self.assertIn(f'{metrics.METRIC_NAME}_bucket{{{labels},le="+Inf"}} 1', rendered)
+
+    def test_counters_registered_once(self):
+        # `python api.py` executes the module body both as __main__ and as api
+        runpy.run_path(api.__file__)
+        rendered = metrics.registry.render()
+        self.assertEqual(rendered.count("# TYPE interests_lookups_total counter"), 1)
+        self.assertEqual(rendered.count("# TYPE score_cache_lookups_total counter"), 1)
+
+
+class TestAsyncSuite(TestSuite):
+    def get_response(self, request):
+        return asyncio.run(async_api.method_handler_async(
+            {"body": request, "headers": self.headers},
+            self.context,
+            self.settings
+        ))
+
+    @cases([
+        b"Content-Length: -1\r\n",
+        b"Content-Length: +2\r\n",
+        b"Content-Length: 2\r\nContent-Length: 2\r\n",
+        b"Content-Length: 2\r\nContent-Length: 0\r\n",
+        b"Transfer-Encoding: chunked\r\n",
+        b"Content-Length: 2\r\nTransfer-Encoding: chunked\r\n",
+    ])
+    def test_invalid_request_head(self, headers):
+        async def post():
+            listener = await asyncio.start_server(
+                async_api.AsyncHTTPServer("127.0.0.1", 0).handle_connection, "127.0.0.1", 0
+            )
+            reader, writer = await asyncio.open_connection(*listener.sockets[0].getsockname())
+            writer.write(b"POST /method/ HTTP/1.1\r\n" + headers + b"\r\n{}")
+            status_line = await reader.readline()
+            rest = await reader.read()
+            writer.close()
+            listener.close()
+            await listener.wait_closed()
+            return status_line, rest
+
+        status_line, rest = asyncio.run(post())
+        self.assertTrue(status_line.startswith(b"HTTP/1.1 400 "))
+        self.assertIn(b"Connection: close", rest)
+        self.assertIn(b'"code":400', rest)
+
+
+class TestStore(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, "store.sock")
+        self.server = KeyValueServer(self.path)
+        self.server.start()
+        self.store = Store(
+            functools.partial(UnixSocketConnection, self.path),
+            pool_size=2,
+            timeout=0.5,
+            retries=1,
+            backoff=0.01
+        )
+        scoring.interests_flight.clear()
+
+    def tearDown(self):
+        self.store.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmp_dir.cleanup()
+
+    def test_get_set(self):
+        self.assertIsNone(self.store.get("missing"))
+        self.store.set("i:1", ["cars", "pets"])
+        self.assertEqual(self.store.get("i:1"), ["cars", "pets"])
+
+    def test_cache_ttl(self):
+        self.store.cache_set("uid:1", 3.0, 0.05)
+        self.assertEqual(self.store.cache_get("uid:1"), 3.0)
+        time.sleep(0.1)
+        self.assertIsNone(self.store.cache_get("uid:1"))
+
+    def test_unavailable_storage(self):
+        missing_path = os.path.join(self.tmp_dir.name, "missing.sock")
+        store = Store(functools.partial(UnixSocketConnection, missing_path), retries=2, backoff=0.01)
+        self.assertIsNone(store.cache_get("uid:1"))
+        store.cache_set("uid:1", 3.0, 60)
+        with self.assertRaises(StoreError):
+            store.get("i:1")
+
+    def test_score_cache(self):
+        scoring.score_cache.clear()
+        args = ("79175002040", "stupnikov@otus.ru")
+        self.assertEqual(scoring.get_score(self.store, *args), 3.0)
+        self.assertEqual(scoring.get_score(self.store, *args), 3.0)
+        key = scoring.score_cache.make_key(*args, None, None, None, None, models.registry.get().key)
+        self.assertEqual(self.store.cache_get(key), 3.0)
+        scoring.score_cache.clear()
+        self.assertEqual(scoring.get_score(self.store, *args), 3.0)
+        stats = scoring.score_cache.stats()
+        self.assertEqual((stats["local_hits"], stats["store_hits"], stats["misses"]), (0, 1, 0))
+        rendered = metrics.registry.render()
+        self.assertIn('score_cache_lookups_total{result="store_hits"} 1', rendered)
+        self.assertIn('score_cache_lookups_total{result="misses"} 0', rendered)
+
+    def test_score_without_cache_storage(self):
+        scoring.score_cache.clear()
+        missing_path = os.path.join(self.tmp_dir.name, "missing.sock")
+        store = Store(functools.partial(UnixSocketConnection, missing_path))
+        self.assertEqual(scoring.get_score(store, "79175002040", "stupnikov@otus.ru"), 3.0)
+        self.assertEqual(scoring.score_cache.stats()["misses"], 1)
+
+    def test_interests_from_store(self):
+        self.store.set("i:1", ["books", "tv"])
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "clients_interests",
+                   "arguments": {"client_ids": [1, 2]}}
+        request["token"] = hashlib.sha512(b"horns&hoofsh&f" + api.SALT.encode()).hexdigest()
+        response, code = api.method_handler({"body": request, "headers": {}}, {}, self.store)
+        self.assertEqual(api.OK, code)
+        self.assertEqual(response[1], ["books", "tv"])
+        self.assertEqual(len(response[2]), 2)
+
+    def test_streamed_interests(self):
+        self.store.set("i:7", ["books", "tv"])
+        client_ids = list(range(api.STREAM_THRESHOLD + 1))
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "clients_interests",
+                   "arguments": {"client_ids": client_ids + [7, 0]}}
+        request["token"] = hashlib.sha512(b"horns&hoofsh&f" + api.SALT.encode()).hexdigest()
+        context = {}
+        response, code = api.method_handler({"body": request, "headers": {}}, context, self.store)
+        self.assertEqual(api.OK, code)
+        self.assertEqual(context["nclients"], len(client_ids))
+        pairs = json.loads(b"".join(response.iter_json()), object_pairs_hook=list)
+        self.assertEqual([int(k) for k, _ in pairs], client_ids)
+        interests = dict(pairs)
+        self.assertEqual(interests["7"], ["books", "tv"])
+
+    def test_coalesced_interests(self):
+        flight = scoring.SingleFlight(ttl=1.0, size=10)
+        fetches = []
+
+        def fetch_many(keys):
+            fetches.append(keys)
+            time.sleep(0.1)
+            return [k.upper() for k in keys]
+
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(flight.get_many(["a", "b", "a"], fetch_many)))
+            for _ in range(8)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(fetches, [["a", "b"]])
+        self.assertEqual(results, [["A", "B", "A"]] * 8)
+        stats = flight.stats()
+        self.assertEqual(stats["fetched"], 2)
+        self.assertEqual(stats["shared"] + stats["recent"], 14)
+
+        def fail(keys):
+            raise StoreError("unavailable")
+
+        self.assertRaises(StoreError, flight.get_many, ["c"], fail)
+        self.assertEqual(flight.flights, {})
+
+
+class TestCodec(unittest.TestCase):
+    def test_read_body(self):
+        body = codec.read_body(io.BytesIO(b'{"client_ids": [1, 2]}'), 22)
+        self.assertEqual(codec.loads(body), {"client_ids": [1, 2]})
+        with self.assertRaises(ValueError):
+            codec.read_body(io.BytesIO(b"{}"), 10)
+
+    @cases([
+        {"response": {1: ["cars", "pets"]}, "code": 200},
+        {"response": {2 ** 70: ["cars", "pets"]}, "code": 200},
+        {"response": {"score": 3.0}, "code": 200},
+    ])
+    def test_dumps(self, response):
+        self.assertEqual(
+            json.loads(codec.dumps(response)),
+            json.loads(json.dumps(response))
+        )
+
+
+class TestModels(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, "models.json")
+        self.saved = models.registry.state
+        scoring.score_cache.clear()
+
+    def tearDown(self):
+        models.registry.state = self.saved
+        self.tmp_dir.cleanup()
+
+    def write_models(self, config, mtime_ns):
+        with open(self.path, "w") as file:
+            json.dump(config, file)
+        os.utime(self.path, ns=(mtime_ns, mtime_ns))
+
+    def score(self, arguments, context=None):
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "online_score", "arguments": arguments}
+        TestSuite.set_valid_auth(self, request)
+        return api.method_handler({"body": request, "headers": {}}, {} if context is None else context, None)
+
+    def test_default_model(self):
+        values = [None, "", "79175002040", 1, 0, datetime.datetime(2000, 1, 1)]
+        model = models.registry.get()
+        for row in itertools.product(values, repeat=6):
+            expected = 1.5 * bool(row[0]) + 1.5 * bool(row[1]) + 1.5 * bool(row[2] and row[3]) + \
+                0.5 * bool(row[4] and row[5])
+            self.assertEqual(model.score(*row), expected, row)
+        rows = [{"phone": 1, "email": "a@b"}, {"first_name": "a", "last_name": "b"}, {}]
+        self.assertEqual(model.score_rows(rows), [3.0, 0.5, 0])
+
+    @cases([
+        {"models": []},
+        {"models": {"m": {"rules": [{"fields": ["phone; import os"], "weight": 1}]}}},
+        {"models": {"m": {"rules": [{"fields": ["phone"], "weight": "1"}]}}},
+        {"models": {"m": {"rules": []}}, "default": "missing"},
+    ])
+    def test_invalid_models(self, config):
+        with self.assertRaises(ValueError):
+            models.registry.load(config)
+        self.assertIs(models.registry.state, self.saved)
+
+    def test_model_argument(self):
+        self.write_models({"models": {"phone_only": {"bias": 1, "rules": [{"fields": ["phone"], "weight": 2}]}}}, 10 ** 9)
+        models.registry.load_file(self.path)
+        arguments = {"phone": "79175002040", "email": "stupnikov@otus.ru"}
+        self.assertEqual(self.score(arguments), ({"score": 3.0}, api.OK))
+        context = {}
+        self.assertEqual(self.score({**arguments, "model": "phone_only"}, context), ({"score": 3}, api.OK))
+        self.assertEqual(sorted(context["has"]), ["email", "phone"])
+        _, code = self.score({**arguments, "model": "missing"})
+        self.assertEqual(code, api.INVALID_REQUEST)
+        phone_only = models.registry.get("phone_only")
+        requests = [{**arguments, "model": phone_only}, arguments, {"first_name": "a", "model": phone_only}]
+        self.assertEqual(scoring.get_scores(None, requests), [3, 3.0, 1])
+
+        # A model resolved by the validation survives a reload removing it.
+        _, score_req, model = api.validate_score_request({**arguments, "model": "phone_only"})
+        models.registry.load({"models": {}})
+        self.assertEqual(scoring.get_score(None, score_req.phone, score_req.email, model=model), 3)
+
+    def test_hot_reload(self):
+        self.write_models({"default": "m", "models": {"m": {"rules": [{"fields": ["phone"], "weight": 1}]}}}, 10 ** 9)
+        models.registry.load_file(self.path)
+        arguments = {"phone": "79175002040", "email": "stupnikov@otus.ru"}
+        self.assertEqual(self.score(arguments)[0], {"score": 1})
+        self.assertFalse(models.registry.reload_if_changed())
+        self.write_models({"default": "m", "models": {"m": {"rules": [{"fields": ["phone"], "weight": 5}]}}}, 2 * 10 ** 9)
+        self.assertTrue(models.registry.reload_if_changed())
+        self.assertEqual(self.score(arguments)[0], {"score": 5})
+        with open(self.path, "w") as file:
+            file.write("{")
+        self.assertFalse(models.registry.reload_if_changed())
+        self.assertEqual(self.score(arguments)[0], {"score": 5})
+
+
+class TestInterests(unittest.TestCase):
+    def test_sample_interests(self):
+        cids = [0, 1, 2, 7, 2 ** 70, -5] + list(range(100, 1100))
+        sampled = scoring.sample_interests_many(cids)
+        self.assertEqual(sampled, [scoring.sample_interests(cid) for cid in cids])
+        self.assertEqual(sampled, scoring.sample_interests_many(cids))
+        for interests in sampled:
+            self.assertEqual(len(set(interests)), 2)
+            self.assertTrue(set(interests) <= set(scoring.INTERESTS))
+        self.assertEqual(len({tuple(i) for i in sampled}), len(scoring.INTERESTS) * (len(scoring.INTERESTS) - 1))
+        self.assertEqual(dict(scoring.get_interests_many(None, [7, 1])), {7: sampled[3], 1: sampled[1]})
+
+
+class TestProfiler(unittest.TestCase):
+    def tearDown(self):
+        profiler.stop()
+
+    def control(self, login, arguments):
+        request = {"account": "horns&hoofs", "login": login, "method": "profile", "arguments": arguments}
+        TestSuite.set_valid_auth(self, request)
+        return api.method_handler({"body": request, "headers": {}}, {}, None)
+
+    def test_forbidden(self):
+        _, code = self.control("h&f", {"action": "result"})
+        self.assertEqual(api.FORBIDDEN, code)
+        self.assertFalse(profiler.armed)
+
+    @cases([
+        {},
+        {"action": "restart"},
+        {"action": "start", "mode": "cprofile"},
+        {"action": "start", "mode": "sample", "seconds": 3600},
+    ])
+    def test_invalid_control(self, arguments):
+        _, code = self.control(ADMIN_LOGIN, arguments)
+        self.assertEqual(api.INVALID_REQUEST, code, arguments)
+
+    def test_request_profile(self):
+        response, code = self.control(ADMIN_LOGIN, {"action": "start", "mode": "cprofile", "requests": 2})
+        self.assertEqual(api.OK, code)
+        self.assertEqual(response["status"], "running")
+        self.assertTrue(profiler.armed)
+        for _ in range(2):
+            handle = profiler.wrap(scoring.get_score)
+            self.assertIsNot(handle, scoring.get_score)
+            self.assertEqual(handle(None, "79175002040", "a@b"), 3.0)
+        self.assertFalse(profiler.armed)
+        self.assertIs(profiler.wrap(scoring.get_score), scoring.get_score)
+        response, code = self.control(ADMIN_LOGIN, {"action": "result"})
+        self.assertEqual(response["status"], "done")
+        self.assertEqual(response["format"], "pstats")
+        self.assertIn("get_score", response["output"])
+
+    def test_sampling_profile(self):
+        response, code = self.control(ADMIN_LOGIN, {"action": "start", "mode": "sample", "seconds": 0.05})
+        self.assertEqual(api.OK, code)
+        self.assertFalse(profiler.armed)
+        time.sleep(0.1)
+        response, code = self.control(ADMIN_LOGIN, {"action": "result"})
+        self.assertEqual(response["status"], "done")
+        self.assertEqual(response["format"], "collapsed")
+        self.assertIn("test_sampling_profile", response["output"])
+
+
+class TestAdmission(unittest.TestCase):
+    def test_admission_controller(self):
+        controller = admission.AdmissionController(max_concurrent=1, max_queue=2, timeout=0.05)
+        self.assertEqual(controller.admit("a"), admission.ADMITTED)
+        self.assertEqual(controller.admit("b"), admission.QUEUED)
+        time.sleep(0.06)
+        self.assertEqual(controller.admit("c"), admission.QUEUED)
+        self.assertEqual(controller.admit("d"), admission.REJECTED)
+        self.assertEqual(controller.release(), ("c", ["b"]))
+        self.assertEqual(controller.release(), (None, []))
+        self.assertEqual(controller.active, 0)
+        controller.max_concurrent = 0
+        self.assertEqual(controller.admit("e"), admission.QUEUED)
+        self.assertEqual(controller.expire(), [])
+        self.assertEqual(controller.expire(time.monotonic() + 1), ["e"])
+
+    def test_rate_limit_after_auth(self):
+        limiter = admission.RateLimiter(rate=0.001, burst=2)
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "online_score", "token": "bad",
+                   "arguments": {"first_name": "a", "last_name": "b"}}
+        for _ in range(3):
+            _, code = api.method_handler({"body": request, "headers": {}, "rate_limiter": limiter}, {}, None)
+            self.assertEqual(code, api.FORBIDDEN)
+        TestSuite.set_valid_auth(self, request)
+        codes = [
+            api.method_handler({"body": request, "headers": {}, "rate_limiter": limiter}, {}, None)[1]
+            for _ in range(3)
+        ]
+        self.assertEqual(codes, [api.OK, api.OK, api.TOO_MANY_REQUESTS])
+
+    def test_overloaded_server(self):
+        def slow_handler(request, context, store):
+            time.sleep(0.3)
+            return {}, api.OK
+
+        handler = type("Handler", (server.MainHTTPHandler,), {"router": {"method": slow_handler}})
+        controller = admission.AdmissionController(max_concurrent=4, max_queue=1, timeout=1)
+        httpd = server.ThreadPoolHTTPServer(("127.0.0.1", 0), handler, 2, controller)
+        self.assertEqual(controller.max_concurrent, 2)
+        thread = threading.Thread(target=httpd.serve_forever)
+        thread.start()
+        results = []
+
+        def post():
+            connection = http.client.HTTPConnection(*httpd.server_address, timeout=5)
+            started_at = time.monotonic()
+            connection.request("POST", "/method/", '{"method": "online_score"}')
+            response = connection.getresponse()
+            body = json.loads(response.read())
+            results.append((response.status, body["code"], time.monotonic() - started_at))
+            connection.close()
+
+        try:
+            clients = [threading.Thread(target=post) for _ in range(8)]
+            for client in clients:
+                client.start()
+            for client in clients:
+                client.join()
+        finally:
+            httpd.shutdown()
+            thread.join()
+            httpd.server_close()
+        codes = sorted(code for _, code, _ in results)
+        self.assertEqual(codes, [api.OK] * 3 + [api.SERVICE_UNAVAILABLE] * 5)
+        self.assertTrue(all(status == code for status, code, _ in results))
+        self.assertLess(max(seconds for _, code, seconds in results if code != api.OK), 0.2)
+
+    def test_rate_limiter(self):
+        limiter = admission.RateLimiter(rate=1000, burst=2)
+        self.assertEqual([limiter.allow("h&f") for _ in range(3)], [True, True, False])
+        self.assertTrue(limiter.allow("admin"))
+        time.sleep(0.01)
+        self.assertTrue(limiter.allow("h&f"))
+
+
+class TestKeepAlive(unittest.TestCase):
+    def setUp(self):
+        self.start({"max_keepalive_requests": 3, "timeout": 0.5})
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "online_score",
+                   "arguments": {"first_name": "a", "last_name": "b"}}
+        TestSuite.set_valid_auth(self, request)
+        self.body = json.dumps(request)
+
+    def tearDown(self):
+        self.connection.close()
+        if self.server is not None:
+            self.stop()
+
+    def start(self, handler_attributes):
+        handler = type("Handler", (server.MainHTTPHandler,), handler_attributes)
+        self.server = server.ThreadPoolHTTPServer(("127.0.0.1", 0), handler, 2)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.connection = http.client.HTTPConnection(*self.server.server_address, timeout=5)
+
+    def stop(self):
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+        self.server = None
+
+    def post(self, body, connection=None):
+        connection = connection or self.connection
+        connection.request("POST", "/method/", body)
+        response = connection.getresponse()
+        return response, response.read()
+
+    def test_persistent_connection(self):
+        sockets = []
+        for _ in range(2):
+            response, data = self.post(self.body)
+            self.assertEqual(response.status, api.OK)
+            self.assertEqual(int(response.getheader("Content-Length")), len(data))
+            self.assertIsNone(response.getheader("Connection"))
+            sockets.append(self.connection.sock)
+        self.assertIs(sockets[0], sockets[1])
+        response, data = self.post("not json")
+        self.assertEqual(json.loads(data)["code"], api.BAD_REQUEST)
+        self.assertEqual(response.getheader("Connection"), "close")
+
+    def test_idle_timeout(self):
+        self.connection.connect()
+        time.sleep(1)
+        self.assertEqual(self.connection.sock.recv(1), b"")
+
+    def test_idle_connections(self):
+        self.stop()
+        self.start({"timeout": 10})
+        # Idle connections outnumbering the workers do not block new ones.
+        connections = [http.client.HTTPConnection(*self.server.server_address, timeout=2) for _ in range(4)]
+        for connection in connections:
+            response, _ = self.post(self.body, connection)
+            self.assertEqual(response.status, api.OK)
+            self.assertIsNone(response.getheader("Connection"))
+        started_at = time.monotonic()
+        self.stop()
+        self.assertLess(time.monotonic() - started_at, 2)
+        for connection in connections:
+            self.assertEqual(connection.sock.recv(1), b"")
+            connection.close()
+
+
+class TestCapture(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, "capture.gz")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_capture_and_replay(self):
+        recorder = capture.TrafficRecorder(self.path, sample_rate=1)
+        recorder.start()
+        bodies = [
+            {"account": "horns&hoofs", "login": "h&f", "method": "online_score",
+             "arguments": {"phone": "79175002040", "email": "stupnikov@otus.ru"}},
+            {"account": "horns&hoofs", "login": "h&f", "method": "clients_interests",
+             "arguments": {"client_ids": [1, 2]}},
+            {"account": "horns&hoofs", "login": ADMIN_LOGIN, "method": "online_score", "arguments": {}},
+            {"account": "horns&hoofs", "login": "h&f", "method": "online_score", "token": "bad", "arguments": {}},
+            {"account": "horns&hoofs", "login": ADMIN_LOGIN, "method": "profile", "arguments": {"action": "result"}},
+        ]
+        for body in bodies[:3] + bodies[4:]:
+            TestSuite.set_valid_auth(self, body)
+        for body in bodies:
+            response, code = api.method_handler({"body": dict(body), "headers": {}}, {}, None)
+            recorder.record(body, response, code, 0.001)
+        recorder.record(bodies[0], {}, api.TOO_MANY_REQUESTS, 0.001)
+        recorder.stop()
+
+        entries = list(capture.read_capture(self.path))
+        self.assertEqual([e["code"] for e in entries], [api.OK, api.OK, api.OK, api.FORBIDDEN])
+        self.assertTrue(all(e["body"]["token"] == capture.REDACTED for e in entries))
+        # The server fails on a body without an account.
+        body = {"login": "h&f", "method": "online_score", "token": capture.REDACTED, "arguments": {}}
+        entries.append({"ts": entries[-1]["ts"], "elapsed": 0.001, "body": body,
+                        "code": api.INTERNAL_ERROR, "response": {}})
+        report = replay.replay(entries)
+        self.assertEqual((report["requests"], report["mismatches"]), (5, 0), report["examples"])
+
+        entries[0]["response"]["score"] = 1.0
+        entries[1]["response"] = {"1": ["cars"]}
+        report = replay.replay(entries)
+        self.assertEqual([e["index"] for e in report["examples"]], [0, 1])
+
+
+class TestBulk(unittest.TestCase):
+    def test_score_file(self):
+        lines = [
+            json.dumps({"arguments": {"phone": "79175002040", "email": "stupnikov@otus.ru"}}),
+            "not json",
+            json.dumps({"first_name": "a", "last_name": "b"}),
+            json.dumps({"arguments": {"phone": "79175002040"}}),
+        ] * 3
+        output = io.BytesIO()
+        input_file = io.BytesIO("\n".join(lines).encode())
+        count = bulk.score_file(input_file, output, bulk.SCORE_MODE, workers=2, chunk_size=2, window=2)
+        self.assertEqual(count, len(lines))
+        results = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEqual([r["code"] for r in results], [200, 400, 200, 422] * 3)
+        self.assertEqual(results[0]["response"], {"score": 3.0})
+
+    def test_method_file(self):
+        bodies = [
+            {"login": "h&f", "method": "online_score", "token": "", "arguments": {}},
+            {"account": "horns&hoofs", "login": "h&f", "method": "clients_interests",
+             "arguments": {"client_ids": list(range(api.STREAM_THRESHOLD + 1))}},
+        ]
+        TestSuite.set_valid_auth(self, bodies[1])
+        output = io.BytesIO()
+        input_file = io.BytesIO("\n".join(json.dumps(body) for body in bodies).encode())
+        bulk.score_file(input_file, output, bulk.METHOD_MODE, workers=1)
+        results = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEqual([r["code"] for r in results], [api.INTERNAL_ERROR, api.OK])
+        self.assertEqual(len(results[1]["response"]), api.STREAM_THRESHOLD + 1)
+
+
+class TestAsyncLogging(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, "api.log")
+        self.root = logging.getLogger()
+        self.saved = (self.root.handlers, self.root.level)
+
+    def tearDown(self):
+        for handler in self.root.handlers:
+            handler.close()
+        self.root.handlers, self.root.level = self.saved
+        logs.sampler = None
+        logs.sampled.set(None)
+        self.tmp_dir.cleanup()
+
+    def read_records(self):
+        with open(self.path) as file:
+            return [json.loads(line) for line in file]
+
+    def test_json_records(self):
+        writer = logs.setup_async_logging(self.path)
+        logging.info("Request %s", {"request_id": "1"})
+        context = {"request_id": "2", "code": 200}
+        logging.info(context)
+        context["code"] = 500
+        writer.stop()
+        records = self.read_records()
+        self.assertEqual(records[0]["level"], "INFO")
+        self.assertEqual(records[0]["msg"], "Request {'request_id': '1'}")
+        self.assertEqual((records[1]["request_id"], records[1]["code"]), ("2", 200))
+        self.assertNotIn("msg", records[1])
+        # A fork after the writer is stopped does not start it again.
+        writer.restart_in_child()
+        self.assertFalse(writer.thread.is_alive())
+
+    def test_sampled_success_records(self):
+        writer = logs.setup_async_logging(self.path, sample_rate=0)
+        logging.info("Success.")
+        logging.error("Failure.")
+        writer.stop()
+        self.assertEqual([r["msg"] for r in self.read_records()], ["Failure."])
+
+    def test_sampled_requests(self):
+        writer = logs.setup_async_logging(self.path, sample_rate=0.5)
+        for i in range(100):
+            logs.start_request()
+            logging.info("Started %d.", i)
+            logging.info("Finished %d.", i)
+        logging.warning("Failed.")
+        writer.stop()
+        messages = [r["msg"] for r in self.read_records()]
+        started = [m.split()[1] for m in messages if m.startswith("Started")]
+        self.assertEqual(started, [m.split()[1] for m in messages if m.startswith("Finished")])
+        self.assertTrue(0 < len(started) < 100)
+        self.assertEqual(messages[-1], "Failed.")
+
 
 if __name__ == "__main__":
     unittest.main()